@@ -18,7 +18,8 @@ from .utils import (
     get_logger, ugettext as _, ignore_error,
 )
 from .service import app_service
-from .recorder import get_replay_recorder
+from .uploader import get_upload_manager
+from .storage import storage_registry
 from .session import Session
 from .models import Connection
 
@@ -63,6 +64,8 @@ class Coco:
     def load_extra_conf_from_server(self):
         configs = app_service.load_config_from_server()
         config.update(configs)
+        # 存储配置变化后重建存储客户端
+        storage_registry.refresh()
 
         tmp = copy.deepcopy(configs)
         tmp['HOST_KEY'] = tmp.get('HOST_KEY', '')[32:50] + '...'
@@ -85,6 +88,8 @@ class Coco:
         self.keep_load_extra_conf()
         self.keep_heartbeat()
         self.monitor_sessions()
+        # 启动录像上传队列, 继续上传上次未完成的任务
+        get_upload_manager()
         if config.UPLOAD_FAILED_REPLAY_ON_START:
             self.upload_failed_replay()
 
@@ -124,40 +129,9 @@ class Coco:
 
     @staticmethod
     def upload_failed_replay():
-        replay_dir = os.path.join(config.REPLAY_DIR)
-
-        def retry_upload_replay(session_id, file_gz_path, target):
-            recorder = get_replay_recorder()
-            recorder.file_gz_path = file_gz_path
-            recorder.session_id = session_id
-            recorder.target = target
-            recorder.upload_replay()
-
-        def check_replay_is_need_upload(full_path):
-            filename = os.path.basename(full_path)
-            suffix = filename.split('.')[-1]
-            if suffix != 'gz':
-                return False
-            session_id = filename.split('.')[0]
-            if len(session_id) != 36:
-                return False
-            return True
-
+        # 上传队列启动时已恢复未完成的任务, 这里只处理旧版本遗留的录像
         def func():
-            if not os.path.isdir(replay_dir):
-                return
-            for d in os.listdir(replay_dir):
-                date_path = os.path.join(replay_dir, d)
-                for filename in os.listdir(date_path):
-                    full_path = os.path.join(date_path, filename)
-                    session_id = filename.split('.')[0]
-                    # 检查是否需要上传
-                    if not check_replay_is_need_upload(full_path):
-                        continue
-                    logger.debug("Retry upload retain replay: {}".format(filename))
-                    target = os.path.join(d, filename)
-                    retry_upload_replay(session_id, full_path, target)
-                    time.sleep(1)
+            get_upload_manager().scan_legacy(config.REPLAY_DIR)
         thread = threading.Thread(target=func)
         thread.start()
 
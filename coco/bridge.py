@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import time
+import threading
+
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors
+
+from .conf import config
+from .struct import SelectEvent
+from .utils import get_logger
+
+logger = get_logger(__file__)
+SWEEP_INTERVAL = 60
+# 有未发送完的数据时, 事件循环的最长等待时间
+FLUSH_INTERVAL = 0.01
+
+
+class SessionSelector:
+    """
+    A session's view of a shared bridge loop, it has the same register and
+    unregister interface as selectors, so `add_watcher`, `add_sharer` work
+    unchanged.
+    """
+
+    def __init__(self, loop, session):
+        self.loop = loop
+        self.session = session
+        self.fileobjs = []
+        self.paused = []
+        self.callback = None
+        self.lock = threading.Lock()
+        self.done_evt = threading.Event()
+
+    def register(self, fileobj, events=selectors.EVENT_READ, data=None):
+        self.loop.register(fileobj, self)
+        self.fileobjs.append(fileobj)
+
+    def unregister(self, fileobj):
+        try:
+            self.fileobjs.remove(fileobj)
+        except ValueError:
+            pass
+        if fileobj in self.paused:
+            self.paused.remove(fileobj)
+        self.loop.unregister(fileobj)
+
+    def pause(self, fileobj):
+        """
+        Stop reading the fileobj until `resume`, the peer is too slow
+        """
+        if fileobj in self.fileobjs and fileobj not in self.paused:
+            self.paused.append(fileobj)
+            self.loop.unregister(fileobj)
+
+    def resume(self, fileobj):
+        if fileobj not in self.paused:
+            return
+        self.paused.remove(fileobj)
+        if not self.done_evt.is_set():
+            self.loop.register(fileobj, self)
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    def wait(self):
+        self.done_evt.wait()
+
+    def close(self):
+        with self.lock:
+            if self.done_evt.is_set():
+                return
+            self.done_evt.set()
+        for fileobj in list(self.fileobjs):
+            self.unregister(fileobj)
+        self.loop.detach(self)
+        if self.callback:
+            # 回调中有请求 api 等阻塞操作, 不能在事件循环中执行
+            thread = threading.Thread(target=self.run_callback)
+            thread.daemon = True
+            thread.start()
+
+    def run_callback(self):
+        try:
+            self.callback()
+        except Exception as e:
+            logger.error("Session {} end callback error: {}".format(
+                self.session, e
+            ))
+            logger.error(e, exc_info=True)
+
+
+class BridgeLoop(threading.Thread):
+    """
+    One event loop, multiplex client, server, stop_evt and change_size_evt
+    of many sessions
+    """
+
+    def __init__(self, index):
+        super(BridgeLoop, self).__init__(name="bridge-loop-{}".format(index))
+        self.daemon = True
+        self.sel = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.wakeup_evt = SelectEvent()
+        self.selectors = set()
+        # 有未发送完的数据的会话, 只在事件循环中访问
+        self.pending = set()
+        self.sel.register(self.wakeup_evt, selectors.EVENT_READ)
+
+    @property
+    def sessions_num(self):
+        return len(self.selectors)
+
+    def wakeup(self):
+        self.wakeup_evt.set()
+
+    def attach(self, selector):
+        with self.lock:
+            self.selectors.add(selector)
+
+    def detach(self, selector):
+        with self.lock:
+            self.selectors.discard(selector)
+
+    def register(self, fileobj, selector):
+        with self.lock:
+            self.sel.register(fileobj, selectors.EVENT_READ, selector)
+        self.wakeup()
+
+    def unregister(self, fileobj):
+        with self.lock:
+            try:
+                self.sel.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+
+    def dispatch(self, selector, fileobj):
+        session = selector.session
+        # 任何异常只结束出错的会话, 不能让事件循环退出
+        try:
+            session.handle_event(fileobj)
+            if session.output_pending:
+                self.pending.add(selector)
+            finished = session.is_finished or not session.is_alive
+        except Exception as e:
+            logger.error("Bridge session {} error: {}".format(session, e))
+            logger.error(e, exc_info=True)
+            session.is_finished = True
+            finished = True
+        if finished:
+            self.close_selector(selector)
+
+    @staticmethod
+    def close_selector(selector):
+        try:
+            selector.close()
+        except Exception as e:
+            logger.error("Close bridge session {} error: {}".format(
+                selector.session, e
+            ))
+            logger.error(e, exc_info=True)
+
+    def flush_pending(self):
+        for selector in list(self.pending):
+            session = selector.session
+            if not selector.done_evt.is_set():
+                try:
+                    session.flush()
+                except Exception as e:
+                    logger.error("Bridge session {} flush error: {}".format(
+                        session, e
+                    ))
+                    session.is_finished = True
+                    self.close_selector(selector)
+            if selector.done_evt.is_set() or not session.output_pending:
+                self.pending.discard(selector)
+
+    def sweep(self):
+        with self.lock:
+            selectors_copy = list(self.selectors)
+        for selector in selectors_copy:
+            try:
+                alive = selector.session.is_alive
+            except Exception as e:
+                logger.error("Check bridge session {} error: {}".format(
+                    selector.session, e
+                ))
+                alive = False
+            if not alive:
+                self.close_selector(selector)
+
+    def run(self):
+        last_sweep = time.time()
+        while True:
+            timeout = FLUSH_INTERVAL if self.pending else SWEEP_INTERVAL
+            try:
+                events = self.sel.select(timeout=timeout)
+            except OSError as e:
+                logger.error("Bridge loop select error: {}".format(e))
+                continue
+            now = time.time()
+            if now - last_sweep >= SWEEP_INTERVAL:
+                self.sweep()
+                last_sweep = now
+            for key, _ in events:
+                if key.fileobj is self.wakeup_evt:
+                    self.wakeup_evt.recv(1024)
+                    continue
+                selector = key.data
+                # 同一轮事件中 session 可能已经结束, 其余的 fd 已被注销
+                if selector is None or selector.done_evt.is_set():
+                    continue
+                self.dispatch(selector, key.fileobj)
+            if self.pending:
+                self.flush_pending()
+
+
+class BridgeEngine:
+    """
+    A fixed pool of bridge loops, replace the thread and selector per session
+    """
+
+    def __init__(self, workers=0):
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.loops = [BridgeLoop(i) for i in range(workers)]
+        for loop in self.loops:
+            loop.start()
+        logger.info("Bridge engine started with {} loops".format(workers))
+
+    def new_selector(self, session):
+        loop = min(self.loops, key=lambda l: l.sessions_num)
+        selector = SessionSelector(loop, session)
+        loop.attach(selector)
+        return selector
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_bridge_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = BridgeEngine(workers=config.BRIDGE_ENGINE_WORKERS)
+    return _engine
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+from .conf import config
+from .service import app_service
+from .struct import TTLCache
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+# 网关详情和系统用户认证信息缓存, 同时登录同一网域、系统用户时只请求一次
+domain_cache = TTLCache()
+auth_info_cache = TTLCache()
+
+
+def get_domain_detail_with_gateway(domain_id):
+    return domain_cache.get_or_load(
+        ('domain', domain_id),
+        lambda: app_service.get_domain_detail_with_gateway(domain_id),
+        ttl=config['DOMAIN_CACHE_TTL'],
+    )
+
+
+def get_system_user_auth_info(system_user, asset):
+    """
+    :return: (password, private_key)
+    """
+    def load():
+        return app_service.get_system_user_auth_info(system_user, asset)
+
+    # 获取失败的不缓存
+    return auth_info_cache.get_or_load(
+        ('auth', system_user.id, asset.id), load,
+        ttl=config['AUTH_INFO_CACHE_TTL'],
+        cache_if=lambda v: bool(v and any(v)),
+    )
+
+
+def invalidate_domain(domain_id=None):
+    if domain_id is None:
+        domain_cache.invalidate()
+    else:
+        domain_cache.invalidate('domain', domain_id)
+
+
+def invalidate_system_user_auth(system_user_id=None, asset_id=None):
+    """
+    Invalidate the auth info of a system user on an asset, or on all the
+    assets if asset_id is None, or all if both None
+    """
+    if system_user_id is None:
+        auth_info_cache.invalidate()
+    elif asset_id is None:
+        auth_info_cache.invalidate('auth', system_user_id)
+    else:
+        auth_info_cache.invalidate('auth', system_user_id, asset_id)
+    logger.debug("Invalidate system user auth info cache: {} {}".format(
+        system_user_id, asset_id
+    ))
+
+
+def invalidate_all():
+    invalidate_domain()
+    invalidate_system_user_auth()
+
+
+def get_stats():
+    return {
+        "domain": domain_cache.to_json(),
+        "auth_info": auth_info_cache.to_json(),
+    }
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import re
+import time
+import threading
+
+from .conf import config
+from .service import app_service
+from .utils import get_logger
+
+logger = get_logger(__file__)
+backref_pattern = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class CommandFilterMatcher:
+    """
+    Compile the command filter rules ordered by priority into combined
+    regexes, so the first ALLOW/DENY rule is found in one pass.
+
+    Each rule becomes a lookahead `(?=.*?(?P<rN>pattern))`, alternatives are
+    tried in order at the start of the command, so the first matched rule
+    wins like evaluating them one by one. Rules can't be merged, such as
+    with back references or their own flags, are evaluated alone, in order.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.segments = []
+        self.compile()
+
+    @staticmethod
+    def get_pattern(rule):
+        # sdk 编译失败的规则返回 ''
+        pattern = getattr(rule, '_pattern', None)
+        if not pattern:
+            return None
+        if isinstance(pattern, str):
+            try:
+                pattern = re.compile(pattern)
+            except re.error:
+                return None
+        return pattern
+
+    @staticmethod
+    def can_merge(pattern):
+        if pattern.flags != re.UNICODE:
+            return False
+        if pattern.groupindex:
+            return False
+        if pattern.groups and backref_pattern.search(pattern.pattern):
+            return False
+        return True
+
+    def compile(self):
+        merged = []
+        for index, rule in enumerate(self.rules):
+            pattern = self.get_pattern(rule)
+            # 无效的规则单独匹配, 由 match_rule 记录警告
+            if pattern is not None and self.can_merge(pattern):
+                merged.append(index)
+                continue
+            self.add_merged(merged)
+            merged = []
+            self.segments.append((None, [index]))
+        self.add_merged(merged)
+
+    def add_merged(self, indexes):
+        if not indexes:
+            return
+        alternatives = [
+            r'(?=.*?(?P<r{}>{}))'.format(i, self.get_pattern(self.rules[i]).pattern)
+            for i in indexes
+        ]
+        try:
+            combined = re.compile(r'(?s)(?:{})'.format('|'.join(alternatives)))
+        except re.error as e:
+            logger.warning("Combine command filter rules failed: {}".format(e))
+            for i in indexes:
+                self.segments.append((None, [i]))
+            return
+        self.segments.append((combined, indexes))
+
+    def match_rule(self, index, command):
+        rule = self.rules[index]
+        action, cmd = rule.match(command)
+        if action in (rule.ALLOW, rule.DENY):
+            return rule, action, cmd
+        if action == rule.ERROR:
+            msg = "Command filter check exceptions " \
+                  "(for safety, check for consistency of rule type " \
+                  "and content in command filter)"
+            logger.warning(msg)
+            _filter = "Command filter rule: {}".format(
+                rule.content.replace('\r\n', ' ')
+            )
+            logger.warning(_filter)
+        return None
+
+    def match(self, command):
+        """
+        :return: (rule, action, matched command) of the first ALLOW or DENY
+                 rule, or (None, None, None)
+        """
+        for combined, indexes in self.segments:
+            if combined is None:
+                result = self.match_rule(indexes[0], command)
+                if result:
+                    return result
+                continue
+            found = combined.match(command)
+            if not found:
+                continue
+            groups = found.groupdict()
+            start = 0
+            for pos, i in enumerate(indexes):
+                if groups.get('r{}'.format(i)) is not None:
+                    start = pos
+                    break
+            # 以规则自身的 match 结果为准
+            for i in indexes[start:]:
+                result = self.match_rule(i, command)
+                if result:
+                    return result
+        return None, None, None
+
+
+class CommandFilterCache:
+    """
+    Command filter rules of system users, fetched once and shared by all
+    the connections, refreshed after `ttl` seconds. Rules are compiled
+    again only when they changed.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(rules):
+        return tuple(
+            (getattr(r, 'id', None), getattr(r, 'priority', None),
+             getattr(r, 'content', None), str(getattr(r, 'action', None)),
+             str(getattr(r, 'type', None)))
+            for r in rules
+        )
+
+    def _get_lock(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def get_matcher(self, system_user_id):
+        item = self._cache.get(system_user_id)
+        if item and item[2] > time.time():
+            return item[0]
+        with self._get_lock(system_user_id):
+            item = self._cache.get(system_user_id)
+            if item and item[2] > time.time():
+                return item[0]
+            rules = app_service.get_system_user_cmd_filter_rules(
+                system_user_id
+            )
+            expired_at = time.time() + config['COMMAND_FILTER_CACHE_TTL']
+            if rules is None:
+                # 获取失败, 继续使用之前的规则
+                if item:
+                    logger.warning("Refresh command filter rules failed, "
+                                   "use the cached rules")
+                    return item[0]
+                return None
+            fingerprint = self.fingerprint(rules)
+            if item and item[1] == fingerprint:
+                matcher = item[0]
+            else:
+                matcher = CommandFilterMatcher(rules)
+            self._cache[system_user_id] = (matcher, fingerprint, expired_at)
+            return matcher
+
+    def invalidate(self, system_user_id=None):
+        if system_user_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(system_user_id, None)
+
+
+cmd_filter_cache = CommandFilterCache()
+
+
+def get_cmd_filter_matcher(system_user_id):
+    return cmd_filter_cache.get_matcher(system_user_id)
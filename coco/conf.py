@@ -378,7 +378,47 @@ defaults = {
     'REUSE_CONNECTION': True,
     'FORCE_REMOVE_FOLDER': False,
     'TELNET_TTYPE': 'XTERM-256COLOR',
-    'ENABLE_PROXY_PROTOCOL': False
+    'ENABLE_PROXY_PROTOCOL': False,
+    'BRIDGE_ENGINE': False,
+    'BRIDGE_ENGINE_WORKERS': 0,  # 0 means cpu count
+    'SUBSCRIBER_BUFFER_SIZE': 1024 * 1024,
+    'BRIDGE_COALESCE_WINDOW': 5,  # ms, 0 means disable
+    'COMMAND_PARSE_WORKERS': 2,
+    'COMMAND_PARSE_QUEUE_SIZE': 1000,
+    'COMMAND_FILTER_CACHE_TTL': 60,
+    'DISABLED_FILTERS': [],  # like ["recv.replay"]
+    'FILTER_STATS': True,
+    'REPLAY_COMPRESS_LEVEL': 6,
+    'REPLAY_FLUSH_INTERVAL': 10,
+    'REPLAY_FRAME_WINDOW': 20,  # ms
+    'REPLAY_BUFFER_SIZE': 64 * 1024,
+    'REPLAY_UPLOAD_WORKERS': 4,
+    'REPLAY_UPLOAD_BACKEND_CONCURRENCY': 2,
+    'REPLAY_UPLOAD_MAX_ATTEMPTS': 3,
+    'REPLAY_UPLOAD_BACKOFF': 5,
+    'REPLAY_UPLOAD_MAX_BACKOFF': 600,
+    'COMMAND_RECORD_WORKERS': 1,
+    'COMMAND_BATCH_SIZE': 10,
+    'COMMAND_BATCH_LINGER': 1,
+    'COMMAND_QUEUE_SIZE': 10000,
+    'COMMAND_SPOOL_DIR': os.path.join(root_path, 'data', 'spool', 'commands'),
+    'COMMAND_SPOOL_SEGMENT_SIZE': 4 * 1024 * 1024,
+    'COMMAND_SPOOL_REPLAY_RATE': 500,
+    'REPLAY_SEGMENT_DURATION': 0,
+    'REPLAY_SEGMENT_SIZE': 0,
+    'REPLAY_INDEX_INTERVAL': 0,
+    'STORAGE_POOL_SIZE': 4,
+    'CONNECTION_POOL_SIZE': 100,
+    'CONNECTION_IDLE_TTL': 300,
+    'CONNECTION_REAP_INTERVAL': 30,
+    'GATEWAY_MAX_CHANNELS': 10,
+    'GATEWAY_MAX_TRANSPORTS': 10,
+    'GATEWAY_IDLE_TTL': 300,
+    'GATEWAY_RACE_STAGGER': 0.25,
+    'GATEWAY_FAILURE_COOLDOWN': 60,
+    'DOMAIN_CACHE_TTL': 60,
+    'AUTH_INFO_CACHE_TTL': 60,
+    'AUTH_METHOD_CACHE_TTL': 24 * 3600,
 }
 
 
@@ -2,8 +2,11 @@
 #
 
 import re
+import time
 import socket
+import threading
 import telnetlib
+from collections import OrderedDict
 from .const import MANUAL_LOGIN
 
 
@@ -14,8 +17,13 @@ except ImportError:
 
 import paramiko
 
-from .service import app_service
 from .conf import config
+from .gateway import get_gateway_pool
+from .cache import (
+    get_domain_detail_with_gateway, get_system_user_auth_info,
+    invalidate_domain, invalidate_system_user_auth,
+)
+from .struct import TTLCache
 from .utils import get_logger, get_private_key_fingerprint
 
 logger = get_logger(__file__)
@@ -23,10 +31,172 @@ logger = get_logger(__file__)
 BUF_SIZE = 1024
 MANUAL_LOGIN = 'manual'
 AUTO_LOGIN = 'auto'
+AUTH_PUBLICKEY = 'publickey'
+AUTH_PASSWORD = 'password'
+
+# 记住每个资产、系统用户上次认证成功的方式
+auth_method_cache = TTLCache(maxsize=100000)
+
+
+class SSHConnectionPool:
+    """
+    Connections can be reused, keyed by `user_asset_systemuser`.
+
+    A connection in use is shared by ref counting, after the last one closed
+    it, it's kept idle at most `idle_ttl` seconds for the next session. At
+    most `max_size` connections are kept, the least recently used idle ones
+    are evicted first, a reaper closes the idle expired and dead ones.
+    """
+
+    def __init__(self, max_size=100, idle_ttl=300, reap_interval=30):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.reap_interval = reap_interval
+        self.connections = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._reaper = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get(self, key):
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection and connection.is_active:
+                self.connections.move_to_end(key)
+                connection.ref += 1
+                connection.idle_since = None
+                self.hits += 1
+                return connection
+            self.misses += 1
+            if connection:
+                self.connections.pop(key, None)
+                self.evictions += 1
+        # 连接已断开, 锁外关闭
+        if connection:
+            connection.close_transport()
+        return None
+
+    def put(self, key, connection):
+        evicted = []
+        with self.lock:
+            old = self.connections.pop(key, None)
+            if old and old is not connection and not old.ref:
+                evicted.append(old)
+            self.connections[key] = connection
+            while len(self.connections) > self.max_size:
+                idle = next(
+                    (k for k, c in self.connections.items() if not c.ref), None
+                )
+                # 都在使用中, 新连接不放入池中
+                if idle is None:
+                    self.connections.pop(key, None)
+                    break
+                evicted.append(self.connections.pop(idle))
+            self.evictions += len(evicted)
+        for c in evicted:
+            c.close_transport()
+        self.start_reaper()
+
+    def release(self, key, connection):
+        """
+        A user closed the pooled connection, the last one leave it idle in
+        the pool.
+
+        :return: True if it's still in the pool, else the caller close it
+        """
+        with self.lock:
+            if self.connections.get(key) is not connection:
+                return False
+            connection.ref -= 1
+            if connection.ref > 0:
+                return True
+            if not self.idle_ttl or not connection.is_active:
+                self.connections.pop(key, None)
+                return False
+            connection.idle_since = time.time()
+            return True
+
+    def remove(self, key, connection):
+        with self.lock:
+            if self.connections.get(key) is connection:
+                self.connections.pop(key, None)
+
+    def reap(self):
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for key, c in list(self.connections.items()):
+                if c.ref and c.is_active:
+                    continue
+                if c.is_active and now - c.idle_since < self.idle_ttl:
+                    continue
+                # 空闲超时或已断开
+                if not c.ref:
+                    evicted.append(c)
+                self.connections.pop(key, None)
+            self.evictions += len(evicted)
+        for c in evicted:
+            c.close_transport()
+        if evicted:
+            logger.debug("Reap {} idle connections".format(len(evicted)))
+
+    def start_reaper(self):
+        if self._reaper is not None:
+            return
+        with self.lock:
+            if self._reaper is not None:
+                return
+
+            def func():
+                while True:
+                    time.sleep(self.reap_interval)
+                    try:
+                        self.reap()
+                    except Exception as e:
+                        logger.error("Reap connections error: {}".format(e))
+
+            self._reaper = threading.Thread(
+                target=func, name='ssh-connection-reaper'
+            )
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def get_stats(self):
+        with self.lock:
+            idle = sum(1 for c in self.connections.values() if not c.ref)
+        return {
+            "size": len(self.connections),
+            "idle": idle,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_ssh_connection_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SSHConnectionPool(
+                max_size=config['CONNECTION_POOL_SIZE'],
+                idle_ttl=config['CONNECTION_IDLE_TTL'],
+                reap_interval=config['CONNECTION_REAP_INTERVAL'],
+            )
+    return _pool
 
 
 class SSHConnection:
-    connections = {}
+    @property
+    def connections(self):
+        return get_ssh_connection_pool().connections
 
     @staticmethod
     def make_key(user, asset, system_user):
@@ -38,21 +208,14 @@ class SSHConnection:
         if not config.REUSE_CONNECTION:
             return None
         key = cls.make_key(user, asset, system_user)
-        connection = cls.connections.get(key)
-        if not connection:
-            return None
-        if not connection.is_active:
-            cls.connections.pop(key, None)
-            return None
-        connection.ref += 1
-        return connection
+        return get_ssh_connection_pool().get(key)
 
     @classmethod
     def set_connection_to_cache(cls, conn):
         if not config.REUSE_CONNECTION:
             return None
         key = cls.make_key(conn.user, conn.asset, conn.system_user)
-        cls.connections[key] = conn
+        get_ssh_connection_pool().put(key, conn)
 
     @classmethod
     def new_connection(cls, user, asset, system_user):
@@ -71,8 +234,8 @@ class SSHConnection:
 
     @classmethod
     def remove_ssh_connection(cls, conn):
-        key = "{}_{}_{}".format(conn.user.id, conn.asset.id, conn.system_user.id)
-        cls.connections.pop(key, None)
+        key = cls.make_key(conn.user, conn.asset, conn.system_user)
+        get_ssh_connection_pool().remove(key, conn)
 
     def __init__(self, user, asset, system_user):
         self.user = user
@@ -83,6 +246,7 @@ class SSHConnection:
         self.sock = None
         self.error = ""
         self.ref = 1
+        self.idle_since = None
 
     def get_system_user_auth(self):
         """
@@ -92,10 +256,65 @@ class SSHConnection:
         if self.system_user.login_mode == MANUAL_LOGIN:
             return
         password, private_key = \
-            app_service.get_system_user_auth_info(self.system_user, self.asset)
+            get_system_user_auth_info(self.system_user, self.asset)
         self.system_user.password = password
         self.system_user.private_key = private_key
 
+    @property
+    def auth_method_key(self):
+        return self.asset.id, self.system_user.id
+
+    def get_auth_methods(self):
+        """
+        The auth methods to try, the last succeeded one first
+        """
+        methods = []
+        if self.system_user.private_key:
+            methods.append(AUTH_PUBLICKEY)
+        if self.system_user.password:
+            methods.append(AUTH_PASSWORD)
+        if not methods:
+            return [AUTH_PUBLICKEY]
+        last = auth_method_cache.get(self.auth_method_key)
+        if last in methods:
+            methods.remove(last)
+            methods.insert(0, last)
+        return methods
+
+    def remember_auth_method(self, transport):
+        auth_handler = getattr(transport, 'auth_handler', None)
+        method = getattr(auth_handler, 'auth_method', None)
+        if method in (AUTH_PUBLICKEY, AUTH_PASSWORD):
+            auth_method_cache.set(
+                self.auth_method_key, method,
+                ttl=config['AUTH_METHOD_CACHE_TTL']
+            )
+
+    def ssh_connect(self, ssh, sock, method):
+        """
+        Connect and auth by one method, the other one is tried on the same
+        transport if failed, see `auth_on_transport`
+        """
+        asset = self.asset
+        system_user = self.system_user
+        if method == AUTH_PUBLICKEY:
+            kwargs = {'pkey': system_user.private_key}
+        else:
+            kwargs = {'password': system_user.password, 'allow_agent': False}
+        ssh.connect(
+            asset.ip, port=asset.ssh_port, username=system_user.username,
+            timeout=config['SSH_TIMEOUT'],
+            compress=False, auth_timeout=config['SSH_TIMEOUT'],
+            look_for_keys=False, sock=sock, **kwargs
+        )
+
+    def auth_on_transport(self, transport, method):
+        username = self.system_user.username
+        if method == AUTH_PUBLICKEY:
+            transport.auth_publickey(username, self.system_user.private_key)
+        else:
+            transport.auth_password(username, self.system_user.password)
+
     def connect(self):
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -113,26 +332,28 @@ class SSHConnection:
 
         asset = self.asset
         system_user = self.system_user
+        methods = self.get_auth_methods()
         try:
             try:
-                ssh.connect(
-                    asset.ip, port=asset.ssh_port, username=system_user.username,
-                    password=system_user.password, pkey=system_user.private_key,
-                    timeout=config['SSH_TIMEOUT'],
-                    compress=False, auth_timeout=config['SSH_TIMEOUT'],
-                    look_for_keys=False, sock=sock
-                )
+                self.ssh_connect(ssh, sock, methods[0])
             except paramiko.AuthenticationException:
-                # 思科设备不支持秘钥登陆，提供秘钥，必然失败
-                ssh.connect(
-                    asset.ip, port=asset.ssh_port, username=system_user.username,
-                    password=system_user.password, timeout=config['SSH_TIMEOUT'],
-                    compress=False, auth_timeout=config['SSH_TIMEOUT'],
-                    look_for_keys=False, sock=sock, allow_agent=False,
-                )
+                if len(methods) < 2:
+                    raise
+                transport = ssh.get_transport()
+                if transport and transport.is_active():
+                    # 在同一连接上尝试其他认证方式, 不必重新连接
+                    self.auth_on_transport(transport, methods[1])
+                else:
+                    # 思科设备不支持秘钥登陆，提供秘钥后会断开连接
+                    if asset.domain:
+                        sock = self.get_proxy_sock_v2(asset)
+                    ssh = paramiko.SSHClient()
+                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                    self.ssh_connect(ssh, sock, methods[1])
             transport = ssh.get_transport()
             transport.set_keepalive(60)
             self.transport = transport
+            self.remember_auth_method(transport)
         except Exception as e:
             password_short = "None"
             key_fingerprint = "None"
@@ -148,6 +369,10 @@ class SSHConnection:
                 password_short, key_fingerprint,
             )
             logger.error(msg)
+            # 认证失败, 可能密码或秘钥已变更, 下次重新获取
+            if isinstance(e, paramiko.AuthenticationException):
+                invalidate_system_user_auth(system_user.id, asset.id)
+                auth_method_cache.invalidate(*self.auth_method_key)
             error += '\r\n' + str(e) if error else str(e)
             ssh, sock, error = None, None, error
         self.client = ssh
@@ -185,6 +410,14 @@ class SSHConnection:
         return self.transport and self.transport.is_active()
 
     def close(self):
+        key = self.make_key(self.user, self.asset, self.system_user)
+        if get_ssh_connection_pool().release(key, self):
+            msg = "Connection ref -1: {}->{}@{}. {}".format(
+                self.user.username, self.asset.hostname,
+                self.system_user.username, self.ref
+            )
+            logger.debug(msg)
+            return
         if self.ref > 1:
             self.ref -= 1
             msg = "Connection ref -1: {}->{}@{}. {}".format(
@@ -193,13 +426,15 @@ class SSHConnection:
             )
             logger.debug(msg)
             return
-        self.__class__.remove_ssh_connection(self)
+        self.close_transport()
+
+    def close_transport(self):
         try:
             self.client.close()
             if self.sock:
                 self.sock.close()
         except Exception as e:
-            logger.error("Close connection error: ", e)
+            logger.error("Close connection error: {}".format(e))
 
         msg = "Close connection: {}->{}@{}. Total connections live: {}".format(
             self.user.username, self.asset.ip,
@@ -209,38 +444,18 @@ class SSHConnection:
 
     @staticmethod
     def get_proxy_sock_v2(asset):
-        sock = None
-        domain = app_service.get_domain_detail_with_gateway(
-            asset.domain
-        )
-        if not domain.has_ssh_gateway():
+        domain = get_domain_detail_with_gateway(asset.domain)
+        if not domain or not domain.has_ssh_gateway():
             return None
-        for gateway in domain.gateways:
-            if gateway.protocol != "ssh":
-                continue
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            try:
-                ssh.connect(gateway.ip, port=gateway.port,
-                            username=gateway.username,
-                            password=gateway.password,
-                            pkey=gateway.private_key_obj,
-                            timeout=config['SSH_TIMEOUT'])
-            except Exception as e:
-                logger.error("Connect gateway error")
-                logger.error(e, exc_info=True)
-                continue
-            try:
-                transport = ssh.get_transport()
-                transport.set_keepalive(60)
-                sock = transport.open_channel(
-                    'direct-tcpip', (asset.ip, asset.ssh_port), ('127.0.0.1', 0)
-                )
-                break
-            except Exception as e:
-                logger.error("Open gateway channel error")
-                logger.error(e, exc_info=True)
-                continue
+        gateways = [g for g in domain.gateways if g.protocol == "ssh"]
+        # 网关连接复用, 多个网关错开并行尝试, 最快的成功者胜出
+        sock = get_gateway_pool().open_channel_race(
+            gateways, (asset.ip, asset.ssh_port),
+            stagger=config['GATEWAY_RACE_STAGGER'],
+        )
+        # 网关都连接失败, 可能网关信息已变更, 下次重新获取
+        if not sock:
+            invalidate_domain(asset.domain)
         return sock
 
 
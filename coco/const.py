@@ -14,3 +14,11 @@ PERMS_ACTION_NAME_DOWNLOAD_FILE = 'download_file'
 #
 MANUAL_LOGIN = 'manual'
 AUTO_LOGIN = 'auto'
+
+#
+# Session events
+#
+SESSION_EVENT_ZMODEM_START = 'zmodem_start'
+SESSION_EVENT_ZMODEM_END = 'zmodem_end'
+SESSION_EVENT_VIM_ENTER = 'vim_enter'
+SESSION_EVENT_VIM_EXIT = 'vim_exit'
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import time
+import queue
+import socket
+import weakref
+import threading
+
+import paramiko
+
+from .conf import config
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+
+class GatewayTransport:
+    """
+    An authenticated ssh transport to a gateway, `direct-tcpip` channels to
+    many assets are opened on it.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.client = None
+        self.transport = None
+        self.channels = weakref.WeakSet()
+        self.idle_since = time.time()
+        # 已分配还未打开的通道数
+        self.reserved = 0
+        # 超过连接数上限时建立的, 空闲后立即关闭
+        self.overflow = False
+        self.discarded = False
+
+    def connect(self):
+        gateway = self.gateway
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(gateway.ip, port=gateway.port,
+                    username=gateway.username,
+                    password=gateway.password,
+                    pkey=gateway.private_key_obj,
+                    timeout=config['SSH_TIMEOUT'])
+        self.client = ssh
+        self.transport = ssh.get_transport()
+        self.transport.set_keepalive(60)
+
+    @property
+    def connecting(self):
+        return self.transport is None
+
+    @property
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    @property
+    def channels_num(self):
+        return sum(1 for chan in list(self.channels) if not chan.closed)
+
+    def open_channel(self, dest_addr):
+        chan = self.transport.open_channel(
+            'direct-tcpip', dest_addr, ('127.0.0.1', 0),
+            timeout=config['SSH_TIMEOUT']
+        )
+        self.channels.add(chan)
+        return chan
+
+    def close(self):
+        if self.client is None:
+            return
+        try:
+            self.client.close()
+        except Exception as e:
+            logger.error("Close gateway transport error: {}".format(e))
+
+
+class GatewayHealth:
+    """
+    Remember the connect latency (EWMA) and failures of gateways, so the
+    fastest healthy one is tried first next time.
+    """
+    alpha = 0.3
+
+    def __init__(self, cooldown=60):
+        self.cooldown = cooldown
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def success(self, key, latency):
+        with self.lock:
+            stat = self.stats.setdefault(key, {"latency": None, "failures": 0})
+            if stat["latency"] is None:
+                stat["latency"] = latency
+            else:
+                stat["latency"] += self.alpha * (latency - stat["latency"])
+            stat["failures"] = 0
+            stat["last_failure"] = None
+
+    def failure(self, key):
+        with self.lock:
+            stat = self.stats.setdefault(key, {"latency": None, "failures": 0})
+            stat["failures"] += 1
+            stat["last_failure"] = time.time()
+
+    def is_healthy(self, key):
+        stat = self.stats.get(key)
+        if not stat or not stat["failures"]:
+            return True
+        return time.time() - stat["last_failure"] > self.cooldown
+
+    def sort_key(self, key):
+        stat = self.stats.get(key) or {}
+        latency = stat.get("latency")
+        # 最近失败的排最后, 未连接过的排在已知延迟的之后
+        return (
+            not self.is_healthy(key),
+            latency is None,
+            latency or 0,
+        )
+
+    def to_json(self):
+        with self.lock:
+            return {k: dict(v) for k, v in self.stats.items()}
+
+
+class GatewayTransportPool:
+    """
+    Keep the gateway transports alive and reuse them, one transport carries
+    at most `max_channels` channels, one gateway keeps at most
+    `max_transports` transports, idle transports are closed after
+    `idle_ttl` seconds. When all of them are full, an extra transport is
+    opened, and closed once idle.
+    """
+
+    def __init__(self, max_channels=10, max_transports=10, idle_ttl=300):
+        self.max_channels = max_channels
+        self.max_transports = max_transports
+        self.idle_ttl = idle_ttl
+        self.transports = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.opened = 0
+        self.reused = 0
+        self.overflowed = 0
+        self._reaper = None
+        self.health = GatewayHealth(cooldown=config['GATEWAY_FAILURE_COOLDOWN'])
+
+    @staticmethod
+    def make_key(gateway):
+        return "{}_{}_{}_{}".format(
+            gateway.id, gateway.ip, gateway.port, gateway.username
+        )
+
+    def acquire(self, gateway):
+        """
+        Reserve a channel on a transport, the transport may be still
+        connecting, see `wait_connected`
+
+        :return: (transport, is_new), connect the transport if is_new
+        """
+        key = self.make_key(gateway)
+        with self.lock:
+            transports = self.transports.setdefault(key, [])
+            transports[:] = [
+                t for t in transports if t.connecting or t.is_active
+            ]
+            # 正在连接的也分配, 同时登录时不必每个都新建连接
+            for t in transports:
+                if t.channels_num + t.reserved < self.max_channels:
+                    t.reserved += 1
+                    self.reused += 1
+                    return t, False
+            t = GatewayTransport(gateway)
+            if len(transports) >= self.max_transports:
+                t.overflow = True
+                self.overflowed += 1
+                logger.warning("Gateway {} reach the max transports, open "
+                               "an extra one".format(gateway.ip))
+            # 先占位, 避免同时建立过多连接
+            t.reserved += 1
+            transports.append(t)
+            self.opened += 1
+            return t, True
+
+    def wait_connected(self, transport):
+        """
+        Wait for a transport connecting by another thread
+
+        :return: True if connected
+        """
+        deadline = time.time() + config['SSH_TIMEOUT']
+        with self.cond:
+            while transport.connecting and not transport.discarded:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self.cond.wait(timeout)
+            return not transport.discarded and not transport.connecting
+
+    def discard(self, gateway, transport):
+        key = self.make_key(gateway)
+        with self.cond:
+            transport.discarded = True
+            transports = self.transports.get(key, [])
+            if transport in transports:
+                transports.remove(transport)
+            self.cond.notify_all()
+        transport.close()
+
+    def open_channel(self, gateway, dest_addr):
+        """
+        Open a `direct-tcpip` channel to dest_addr through the gateway, on a
+        transport kept alive or a new one. The transport is closed only if
+        itself is broken, not if the gateway refused the channel.
+
+        :return: the channel, or None
+        """
+        key = self.make_key(gateway)
+        start = time.time()
+        for i in range(2):
+            transport, is_new = self.acquire(gateway)
+            try:
+                if is_new:
+                    try:
+                        transport.connect()
+                    finally:
+                        with self.cond:
+                            self.cond.notify_all()
+                    self.start_reaper()
+                elif not self.wait_connected(transport):
+                    # 等待的连接失败或超时, 重新分配
+                    continue
+                chan = transport.open_channel(dest_addr)
+                self.health.success(key, time.time() - start)
+                return chan
+            except paramiko.ChannelException as e:
+                # 资产不可达等, 网关连接正常, 不影响其上的其他会话
+                logger.error("Gateway {} open channel to {} failed: {}".format(
+                    gateway.ip, dest_addr, e
+                ))
+                return None
+            except Exception as e:
+                logger.error("Open gateway channel error: {}".format(e))
+                logger.debug(e, exc_info=True)
+                broken = isinstance(e, (paramiko.SSHException, EOFError,
+                                        socket.error))
+                if transport.is_active and not broken:
+                    return None
+                self.discard(gateway, transport)
+                self.health.failure(key)
+                # 新建立的连接也失败了, 不再重试
+                if is_new:
+                    return None
+            finally:
+                with self.lock:
+                    transport.reserved -= 1
+        return None
+
+    def sort_gateways(self, gateways):
+        return sorted(
+            gateways, key=lambda g: self.health.sort_key(self.make_key(g))
+        )
+
+    def open_channel_race(self, gateways, dest_addr, stagger=0.25):
+        """
+        Happy eyeballs: try the gateways, the fastest healthy first, start
+        the next one after `stagger` seconds or the previous failed, the
+        first opened channel wins, the later ones are closed.
+
+        :return: the channel, or None
+        """
+        gateways = self.sort_gateways(gateways)
+        results = queue.Queue()
+        state = {"winner": None}
+        state_lock = threading.Lock()
+
+        def attempt(gateway):
+            if state["winner"] is not None:
+                return
+            # 网关的健康状况在 open_channel 中记录
+            chan = self.open_channel(gateway, dest_addr)
+            if chan is None:
+                results.put((gateway, None))
+                return
+            with state_lock:
+                lost = state["winner"] is not None
+                if not lost:
+                    state["winner"] = chan
+            # 已有其他网关连接成功, 取消本次连接
+            if lost:
+                chan.close()
+                return
+            results.put((gateway, chan))
+
+        started = 0
+        finished = 0
+        # 每个尝试都受 SSH_TIMEOUT 限制, 这里只是兜底
+        deadline = time.time() + config['SSH_TIMEOUT'] * 2 + \
+            stagger * len(gateways)
+        while finished < len(gateways):
+            # 每隔 stagger 秒或上一个失败后, 开始尝试下一个
+            if started < len(gateways):
+                thread = threading.Thread(
+                    target=attempt, args=(gateways[started],)
+                )
+                thread.daemon = True
+                thread.start()
+                started += 1
+                timeout = stagger
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                gateway, chan = results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            finished += 1
+            if chan is not None:
+                logger.debug("Connect gateway {} won".format(gateway.ip))
+                return chan
+        with state_lock:
+            chan = state["winner"]
+            # 超时后不再接受连接
+            state["winner"] = chan or False
+        return chan
+
+    def reap(self):
+        now = time.time()
+        closed = []
+        with self.lock:
+            for key, transports in list(self.transports.items()):
+                alive = []
+                for t in transports:
+                    if t.channels_num or t.reserved:
+                        t.idle_since = now
+                    idle_ttl = 0 if t.overflow else self.idle_ttl
+                    if t.transport is None:
+                        # 正在连接
+                        alive.append(t)
+                    elif not t.is_active or now - t.idle_since > idle_ttl:
+                        closed.append(t)
+                    else:
+                        alive.append(t)
+                if alive:
+                    self.transports[key] = alive
+                else:
+                    self.transports.pop(key, None)
+        for t in closed:
+            t.close()
+
+    def start_reaper(self):
+        with self.lock:
+            if self._reaper is not None:
+                return
+
+            def func():
+                while True:
+                    time.sleep(60)
+                    try:
+                        self.reap()
+                    except Exception as e:
+                        logger.error("Reap gateway error: {}".format(e))
+
+            self._reaper = threading.Thread(target=func, name='gateway-reaper')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def get_stats(self):
+        with self.lock:
+            transports = [t for ts in self.transports.values() for t in ts]
+        return {
+            "transports": len(transports),
+            "channels": sum(t.channels_num for t in transports),
+            "opened": self.opened,
+            "reused": self.reused,
+            "overflowed": self.overflowed,
+            "health": self.health.to_json(),
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_gateway_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = GatewayTransportPool(
+                max_channels=config['GATEWAY_MAX_CHANNELS'],
+                max_transports=config['GATEWAY_MAX_TRANSPORTS'],
+                idle_ttl=config['GATEWAY_IDLE_TTL'],
+            )
+    return _pool
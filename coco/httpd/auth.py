@@ -28,3 +28,15 @@ def login_required(func):
         response = func(*args, **kwargs)
         return response
     return wrapper
+
+
+def admin_required(func):
+    @wraps(func)
+    @login_required
+    def wrapper(*args, **kwargs):
+        user = request.current_user
+        if not getattr(user, 'is_superuser', False) and \
+                getattr(user, 'role', None) != 'Admin':
+            abort(403)
+        return func(*args, **kwargs)
+    return wrapper
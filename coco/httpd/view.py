@@ -7,8 +7,15 @@ from coco.utils import get_logger
 from .app import app
 from .elfinder import connector, volumes
 from ..models import Connection
+from ..session import Session
+from ..pipeline import pipeline_stats
+from ..recorder import get_command_recorder
+from ..uploader import get_upload_manager
+from ..connection import get_ssh_connection_pool
+from ..gateway import get_gateway_pool
+from ..cache import get_stats as get_cache_stats
 from ..sftp import InternalSFTPClient
-from .auth import login_required
+from .auth import login_required, admin_required
 from .utils import get_cached_volume, set_cache_volume
 from ..service import app_service
 
@@ -61,4 +68,15 @@ def sftp_finder():
     return render_template('elfinder/file_manager.html', host='_')
 
 
-
+@app.route('/coco/stats/')
+@admin_required
+def stats():
+    return jsonify({
+        'filters': pipeline_stats.to_json(),
+        'commands': get_command_recorder().get_stats(),
+        'replay_upload': get_upload_manager().get_stats(),
+        'ssh_connections': get_ssh_connection_pool().get_stats(),
+        'gateways': get_gateway_pool().get_stats(),
+        'caches': get_cache_stats(),
+        'sessions': [s.get_stats() for s in list(Session.sessions.values())],
+    })
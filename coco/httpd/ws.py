@@ -91,13 +91,18 @@ class ProxyNamespace(BaseNamespace):
             return
         forwarder = ProxyServer(client, asset, system_user)
 
+        def logout():
+            self.logout(client_id, connection)
+
         def proxy():
             try:
-                forwarder.proxy()
+                # 由共享的事件循环桥接时, 会话结束后再退出
+                if forwarder.proxy(callback=logout):
+                    return
             except Exception as e:
                 logger.error("Unexpected error occur: {}".format(e))
                 logger.error(e, exc_info=True)
-            self.logout(client_id, connection)
+            logout()
         self.socketio.start_background_task(proxy)
 
     def on_data(self, message):
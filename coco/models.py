@@ -3,16 +3,41 @@
 import weakref
 import uuid
 import socket
-
-from .service import app_service
-from .struct import SizedList, SelectEvent
+import time
+import threading
+from collections import deque
+
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors
+
+from .conf import config
+from .cmd_filter import get_cmd_filter_matcher
+from .pipeline import FilterPipeline, timeit
+from .struct import RingBuffer, SelectEvent, WorkerPool, StreamScanner
 from .utils import wrap_with_line_feed as wr, wrap_with_warning as warning, \
     ugettext as _
-from . import char, utils
+from . import char, utils, const
 from .compat import str
 
 BUF_SIZE = 4096
+ZMODEM_BUF_SIZE = 64 * 1024
 logger = utils.get_logger(__file__)
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = WorkerPool(
+                workers=config['COMMAND_PARSE_WORKERS'],
+                maxsize=config['COMMAND_PARSE_QUEUE_SIZE'],
+                name='command-parser'
+            )
+    return _parse_pool
 
 
 class Connection(object):
@@ -153,6 +178,149 @@ class Client(object):
         return "<%s from %s:%s>" % (self.user, self.addr[0], self.addr[1])
 
 
+class SubscriberWriter(object):
+    """
+    Send data to a watcher or sharer in its own thread through a bounded
+    buffer, so a slow subscriber never blocks the session.
+
+    When the buffer is over `max_size` bytes, the oldest data is dropped,
+    pending chunks are coalesced into one send. Data pending when closed is
+    still sent, if within `close_timeout` seconds.
+    """
+    close_timeout = 5
+
+    def __init__(self, client, max_size=None):
+        self.client = client
+        self.max_size = max_size or config['SUBSCRIBER_BUFFER_SIZE']
+        self.buffer = deque()
+        self.size = 0
+        self.dropped = 0
+        self.stopped = False
+        self.stop_deadline = None
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, data):
+        if not data:
+            return 0
+        with self.cond:
+            if self.stopped:
+                return 0
+            self.buffer.append(data)
+            self.size += len(data)
+            while self.size > self.max_size and len(self.buffer) > 1:
+                dropped = self.buffer.popleft()
+                self.size -= len(dropped)
+                self.dropped += len(dropped)
+            self.cond.notify()
+        return len(data)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.buffer and not self.stopped:
+                    self.cond.wait()
+                if not self.buffer:
+                    break
+                # 关闭后仍发送剩余的数据, 超时则丢弃
+                if self.stopped and time.time() > self.stop_deadline:
+                    self.dropped += self.size
+                    break
+                data = b''.join(self.buffer)
+                self.buffer.clear()
+                self.size = 0
+            self.client.send(data)
+        if self.dropped:
+            logger.warning("Subscriber {} too slow, dropped {} bytes".format(
+                self.client, self.dropped
+            ))
+
+    def close(self):
+        with self.cond:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.stop_deadline = time.time() + self.close_timeout
+            self.cond.notify()
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+    def __str__(self):
+        return str(self.client)
+
+
+class NonBlockingWriter(object):
+    """
+    Write to a client or server channel in the shared bridge loop without
+    blocking it, data the channel can't take now is kept and flushed by the
+    loop later. The session stops reading the other side when over
+    `max_size` bytes are kept, so a slow peer only slows down itself.
+    """
+
+    def __init__(self, chan, max_size=None):
+        self.chan = chan
+        self.max_size = max_size or config['SUBSCRIBER_BUFFER_SIZE']
+        self.buffer = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        self._selector = None
+
+    @property
+    def pending(self):
+        return self.size > 0
+
+    @property
+    def full(self):
+        return self.size >= self.max_size
+
+    def writable(self):
+        send_ready = getattr(self.chan, 'send_ready', None)
+        if send_ready is not None:
+            return send_ready()
+        # telnet 的 socket 等
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.chan, selectors.EVENT_WRITE)
+        return bool(self._selector.select(0))
+
+    def write(self, data):
+        if data:
+            with self.lock:
+                self.buffer.append(data)
+                self.size += len(data)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            while self.buffer and self.writable():
+                data = self.buffer[0]
+                n = self.chan.send(data)
+                # web 终端的 send 没有返回值, 一次全部发送
+                if n is None:
+                    n = len(data)
+                # 连接已经断开, 由 session 处理
+                if not n:
+                    self.buffer.clear()
+                    self.size = 0
+                    break
+                self.size -= n
+                if n < len(data):
+                    self.buffer[0] = data[n:]
+                else:
+                    self.buffer.popleft()
+
+    def close(self):
+        with self.lock:
+            self.buffer.clear()
+            self.size = 0
+            if self._selector is not None:
+                self._selector.close()
+                self._selector = None
+
+
 class ServerFilter(object):
     def run(self, data):
         pass
@@ -163,11 +331,28 @@ class BaseServer(object):
     Base Server
     Achieve command record
     sub-class: Server, Telnet Server
+
+    Filters run in order of `send_filters` and `recv_filters`, items are
+    (stage name, method name), sub-class can change them, deployment can
+    disable stages with `DISABLED_FILTERS`, like `send.cmd_filter`
     """
+    send_filters = [
+        ('initial', 's_initial_filter'),
+        ('input_state', 's_input_state_filter'),
+        ('parse_input_output', 's_parse_input_output_filter'),
+        ('cmd_filter', 's_filter_cmd_filter'),
+    ]
+    recv_filters = [
+        ('mark_state', 'r_mark_state_filter'),
+        ('zmodem_disable', 'r_zmodem_disable_filter'),
+        ('replay', 'r_replay_filter'),
+        ('input_output_data', 'r_input_output_data_filter'),
+    ]
 
     def __init__(self, chan=None):
         self.chan = chan
         self._session_ref = None
+        self._recv_selector = None
 
         self._pre_input_state = True
         self._in_input_state = True
@@ -177,10 +362,9 @@ class BaseServer(object):
         self._exit_vim_mark = b'\x1b[37;1H\x1b[K\x1b'
         self._in_vim_state = False
 
-        self.input_data = SizedList(maxsize=1024)
-        self.output_data = SizedList(maxsize=1024)
+        self.input_data = RingBuffer(maxsize=1024)
+        self.output_data = RingBuffer(maxsize=1024)
         self._input = ""
-        self._output = ""
 
         self._zmodem_recv_start_mark = b'rz waiting to receive.**\x18B0100'
         self._zmodem_send_start_mark = b'**\x18B00000000000000'
@@ -189,15 +373,28 @@ class BaseServer(object):
         self._zmodem_state_send = 'send'
         self._zmodem_state_recv = 'recv'
         self._zmodem_state = ''
+        self._zmodem_transfer = None
+        self.zmodem_transfers = []
+        self._mark_scanner = StreamScanner({
+            'vim_enter': self._enter_vim_mark,
+            'vim_exit': self._exit_vim_mark,
+            'zmodem_recv_start': self._zmodem_recv_start_mark,
+            'zmodem_send_start': self._zmodem_send_start_mark,
+            'zmodem_cancel': self._zmodem_cancel_mark,
+            'zmodem_end': self._zmodem_end_mark,
+        })
 
         self._cmd_parser = utils.TtyIOParser()
-        self._cmd_filter_rules = self.get_system_user_cmd_filter_rules()
+        self._cmd_filter = self.get_system_user_cmd_filter()
+        self._send_pipeline = FilterPipeline('send', [
+            (name, getattr(self, method)) for name, method in self.send_filters
+        ])
+        self._recv_pipeline = FilterPipeline('recv', [
+            (name, getattr(self, method)) for name, method in self.recv_filters
+        ])
 
-    def get_system_user_cmd_filter_rules(self):
-        rules = app_service.get_system_user_cmd_filter_rules(
-            self.system_user.id
-        )
-        return rules
+    def get_system_user_cmd_filter(self):
+        return get_cmd_filter_matcher(self.system_user.id)
 
     def set_session(self, session):
         self._session_ref = weakref.ref(session)
@@ -226,50 +423,46 @@ class BaseServer(object):
         return data
 
     def s_parse_input_output_filter(self, data):
-        # 输入了回车键, 计算输入的命令
+        # 输入了回车键, 计算输入的命令, 命令过滤需要, 所以同步解析
         if not self._in_input_state:
             self._input = self._parse_input()
         # 用户输入了内容，但是上次没在输入状态，也就是用户刚开始输入了，结算上次输出内容
         if not self._pre_input_state and self._in_input_state:
-            self._output = self._parse_output()
-            # logger.debug("\n{}\nInput: {}\nOutput: {}\n{}".format(
-            #     "#" * 30 + " Command " + "#" * 30,
-            #     self._input, self._output,
-            #     "#" * 30 + " End " + "#" * 30,
-            # ))
-            if self._input:
-                self.session.put_command(self._input, self._output)
+            session = self.session
+            if self._input and session:
+                # 保存快照, 在后台线程中解析输出并记录命令
+                output_data = self.output_data.getvalue()
+                args = (session, self._input, output_data, time.time())
+                pool = get_parse_pool()
+                if not pool.submit(id(self), self.record_command, *args):
+                    logger.warning("Command parse queue is full")
+                    self.record_command(*args)
             self.input_data.clean()
             self.output_data.clean()
         return data
 
+    @staticmethod
+    @timeit('worker.record_command')
+    def record_command(session, _input, output_data, timestamp):
+        output = ''
+        if output_data:
+            output = utils.TtyIOParser().parse_output([output_data])
+        session.put_command(_input, output, timestamp=timestamp)
+
     def s_filter_cmd_filter(self, data):
         if self._in_input_state:
             return data
         if not self._input:
             return data
-        if self._cmd_filter_rules is None:
+        if self._cmd_filter is None:
             msg = _("Warning: Failed to load filter rule, "
                     "please press Ctrl + D to exit retry.")
             data = self.command_forbidden(msg)
             return data
-        for rule in self._cmd_filter_rules:
-            action, cmd = rule.match(self._input)
-            if action == rule.ALLOW:
-                break
-            elif action == rule.DENY:
-                msg = _("Command `{}` is forbidden ........").format(cmd)
-                data = self.command_forbidden(msg)
-                break
-            elif action == rule.ERROR:
-                msg = "Command filter check exceptions " \
-                      "(for safety, check for consistency of rule type " \
-                      "and content in command filter)"
-                logger.warning(msg)
-                _filter = "Command filter rule: {}".format(
-                    rule.content.replace('\r\n', ' ')
-                )
-                logger.warning(_filter)
+        rule, action, cmd = self._cmd_filter.match(self._input)
+        if rule and action == rule.DENY:
+            msg = _("Command `{}` is forbidden ........").format(cmd)
+            data = self.command_forbidden(msg)
         return data
 
     def command_forbidden(self, msg):
@@ -285,16 +478,78 @@ class BaseServer(object):
     def r_replay_filter(self, data):
         if not self._zmodem_state:
             self.session.put_replay(data)
+        return data
 
-    def r_vim_state_filter(self, data):
-        if self._zmodem_state:
-            return data
-        if self._in_vim_state and data[:11] == self._exit_vim_mark:
-            self._in_vim_state = False
-        elif not self._in_vim_state and data[:17] == self._enter_vim_mark:
-            self._in_vim_state = True
+    def r_mark_state_filter(self, data):
+        """
+        Scan vim and zmodem marks in one pass, and change the state in the
+        order they appear
+        """
+        for mark in self._mark_scanner.scan(data):
+            if mark == 'zmodem_recv_start' and not self._zmodem_state:
+                self.set_zmodem_state(self._zmodem_state_recv)
+            elif mark == 'zmodem_send_start' and not self._zmodem_state:
+                self.set_zmodem_state(self._zmodem_state_send)
+            elif mark == 'zmodem_end' and self._zmodem_state:
+                self.set_zmodem_state('', reason='end')
+            elif mark == 'zmodem_cancel' and self._zmodem_state:
+                self.set_zmodem_state('', reason='cancel')
+            elif self._zmodem_state:
+                continue
+            elif mark == 'vim_enter' and not self._in_vim_state:
+                self.set_vim_state(True)
+            elif mark == 'vim_exit' and self._in_vim_state:
+                self.set_vim_state(False)
         return data
 
+    def set_zmodem_state(self, state, reason=''):
+        logger.debug("Zmodem state => {}".format(state or reason))
+        self._zmodem_state = state
+        if state:
+            self._zmodem_transfer = {
+                "state": state,
+                "date_start": time.time(),
+                "bytes_from_server": 0,
+                "bytes_to_server": 0,
+            }
+            self.fire_session_event(
+                const.SESSION_EVENT_ZMODEM_START, state=state
+            )
+            return
+        transfer = self._zmodem_transfer
+        self._zmodem_transfer = None
+        if transfer:
+            transfer["result"] = reason
+            transfer["duration"] = round(time.time() - transfer["date_start"], 3)
+            self.zmodem_transfers.append(transfer)
+            session = self.session
+            msg = "Zmodem {} {} on {}: from server {} bytes, to server {} " \
+                  "bytes, duration {}s".format(
+                      transfer["state"], reason, session,
+                      transfer["bytes_from_server"],
+                      transfer["bytes_to_server"], transfer["duration"],
+                  )
+            logger.info(msg)
+        self.fire_session_event(
+            const.SESSION_EVENT_ZMODEM_END, reason=reason, transfer=transfer
+        )
+
+    @property
+    def in_zmodem(self):
+        return bool(self._zmodem_state)
+
+    def set_vim_state(self, state):
+        self._in_vim_state = state
+        if state:
+            self.fire_session_event(const.SESSION_EVENT_VIM_ENTER)
+        else:
+            self.fire_session_event(const.SESSION_EVENT_VIM_EXIT)
+
+    def fire_session_event(self, event, **kwargs):
+        session = self.session
+        if session:
+            session.fire_event(event, **kwargs)
+
     def r_input_output_data_filter(self, data):
         if not self._input_initial:
             return data
@@ -306,47 +561,90 @@ class BaseServer(object):
             self.output_data.append(data)
         return data
 
-    def r_zmodem_state_filter(self, data):
-        if not self._zmodem_state:
-            if data[:50].find(self._zmodem_recv_start_mark) != -1:
-                logger.debug("Zmodem state => recv")
-                self._zmodem_state = self._zmodem_state_recv
-            elif data[:24].find(self._zmodem_send_start_mark) != -1:
-                logger.debug("Zmodem state => send")
-                self._zmodem_state = self._zmodem_state_send
-        if self._zmodem_state:
-            if data[:24].find(self._zmodem_end_mark) != -1:
-                logger.debug("Zmodem state => end")
-                self._zmodem_state = ''
-            elif data[:24].find(self._zmodem_cancel_mark) != -1:
-                logger.debug("Zmodem state => cancel")
-                self._zmodem_state = ''
-
     def r_zmodem_disable_filter(self, data=''):
         if self._zmodem_state:
             pass
             # self.chan.send(self._zmodem_cancel_mark)
             # self.chan.send("Zmodem disabled")
+        return data
 
     def send(self, data):
-        self.s_initial_filter(data)
-        self.s_input_state_filter(data)
-        try:
-            self.s_parse_input_output_filter(data)
-            data = self.s_filter_cmd_filter(data)
-        except Exception as e:
-            logger.error(e, exc_info=True)
-        return self.chan.send(data)
+        return self.chan.send(self.filter_send(data))
 
-    def recv(self, size):
+    def filter_send(self, data):
+        """
+        Run the send filters, return the data to send to the server
+        """
+        if self._zmodem_state:
+            return self.zmodem_passthrough_send(data)
+        return self._send_pipeline.run(data)
+
+    def recv(self, size, window=0, max_size=0, wait=True):
+        """
+        :param size: read size
+        :param window: if the read fill up the buffer, keep reading what
+                       arrives within `window` seconds, and filter them once
+        :param max_size: max size of coalesced data
+        :param wait: wait for the data within `window`, or only take what
+                     already arrived, such as in the shared bridge loop
+        :return:
+        """
         data = self.chan.recv(size)
-        self.r_zmodem_state_filter(data)
-        self.r_vim_state_filter(data)
-        self.r_zmodem_disable_filter(data)
-        self.r_replay_filter(data)
-        self.r_input_output_data_filter(data)
+        if self._zmodem_state:
+            return self.zmodem_passthrough_recv(data)
+        if window and len(data) >= size:
+            data = self._recv_within(
+                data, size, window, max_size or size, wait=wait
+            )
+        self._recv_pipeline.run(data)
+        return data
+
+    def zmodem_passthrough_send(self, data):
+        self._zmodem_transfer["bytes_to_server"] += len(data)
+        return data
+
+    def zmodem_passthrough_recv(self, data):
+        """
+        During zmodem transfer, only look for the end and cancel marks,
+        no replay recording or command parsing
+        """
+        self._zmodem_transfer["bytes_from_server"] += len(data)
+        self.r_mark_state_filter(data)
         return data
 
+    def _recv_within(self, data, size, window, max_size, wait=True):
+        chunks = [data]
+        total = len(data)
+        deadline = time.time() + window
+        while total < max_size:
+            if not self._recv_ready():
+                timeout = deadline - time.time()
+                if not wait or timeout <= 0:
+                    break
+                if not self._wait_recv_ready(timeout):
+                    break
+            chunk = self.chan.recv(min(size, max_size - total))
+            # 连接断开, 下次读取时再由 session 处理
+            if not chunk:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        return b''.join(chunks)
+
+    def _recv_ready(self):
+        recv_ready = getattr(self.chan, 'recv_ready', None)
+        if recv_ready is not None:
+            return recv_ready()
+        # telnet 的 socket
+        return self._wait_recv_ready(0)
+
+    def _wait_recv_ready(self, timeout):
+        # 不用 select.select, 它不支持大于 1024 的 fd
+        if self._recv_selector is None:
+            self._recv_selector = selectors.DefaultSelector()
+            self._recv_selector.register(self.chan, selectors.EVENT_READ)
+        return bool(self._recv_selector.select(timeout))
+
     @staticmethod
     def _have_enter_char(s):
         for c in char.ENTER_CHAR:
@@ -354,15 +652,10 @@ class BaseServer(object):
                 return True
         return False
 
-    def _parse_output(self):
-        if not self.output_data:
-            return ''
-        return self._cmd_parser.parse_output(self.output_data)
-
     def _parse_input(self):
         if not self.input_data:
             return
-        return self._cmd_parser.parse_input(self.input_data)
+        return self._cmd_parser.parse_input(self.input_data.views())
 
     def fileno(self):
         return self.chan.fileno()
@@ -371,6 +664,8 @@ class BaseServer(object):
         logger.info("Close server to {}".format(self))
         self.s_input_state_filter(b'')
         self.s_parse_input_output_filter(b'')
+        if self._recv_selector is not None:
+            self._recv_selector.close()
         self.chan.close()
 
     def __getattr__(self, item):
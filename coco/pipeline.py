@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import time
+import bisect
+import threading
+from functools import wraps
+
+from .conf import config
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+# 耗时分桶的上界, 单位微秒
+BUCKETS = [
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+    10000, 20000, 50000, 100000, 200000, 500000, 1000000,
+]
+
+
+class StageStats:
+    """
+    Cumulative time and count of a stage, the p99 is estimated by buckets
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        index = bisect.bisect_left(BUCKETS, seconds * 1000000)
+        self.buckets[index] += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = self.count * p
+        count = 0
+        for index, n in enumerate(self.buckets):
+            count += n
+            if count >= target:
+                if index < len(BUCKETS):
+                    return BUCKETS[index] / 1000000
+                return self.max
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "avg": round(self.total / self.count, 6) if self.count else 0,
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 6),
+        }
+
+
+class PipelineStats:
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def get_stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            with self.lock:
+                stage = self.stages.setdefault(name, StageStats(name))
+        return stage
+
+    def record(self, name, seconds):
+        self.get_stage(name).record(seconds)
+
+    def to_json(self):
+        return {name: stage.to_json() for name, stage in self.stages.items()}
+
+
+pipeline_stats = PipelineStats()
+
+
+class FilterPipeline:
+    """
+    A chain of filter stages, each stage get the data and return it, maybe
+    changed. Stages listed in config `DISABLED_FILTERS`, such as
+    `recv.replay`, are skipped.
+    """
+    def __init__(self, name, stages):
+        """
+        :param name: pipeline name, like send, recv
+        :param stages: [(stage_name, func), ...]
+        """
+        self.name = name
+        disabled = config['DISABLED_FILTERS'] or []
+        self.stages = []
+        for stage_name, func in stages:
+            full_name = '{}.{}'.format(name, stage_name)
+            if full_name in disabled:
+                continue
+            self.stages.append((full_name, func))
+
+    def run(self, data):
+        timing = config['FILTER_STATS']
+        for name, func in self.stages:
+            start = time.perf_counter() if timing else 0
+            try:
+                data = func(data)
+            except Exception as e:
+                logger.error("Filter {} error: {}".format(name, e))
+                logger.error(e, exc_info=True)
+            if timing:
+                pipeline_stats.record(name, time.perf_counter() - start)
+        return data
+
+
+def timeit(name):
+    """
+    Record the time of a function not in pipeline, such as run in workers
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not config['FILTER_STATS']:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                pipeline_stats.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -13,6 +13,7 @@ from .const import (
 )
 from .connection import SSHConnection, TelnetConnection
 from .service import app_service
+from .cache import get_system_user_auth_info
 from .conf import config
 from .utils import (
     wrap_with_line_feed as wr, wrap_with_warning as warning, ugettext as _,
@@ -38,7 +39,7 @@ class ProxyServer:
         :return: system user have full info
         """
         password, private_key = \
-            app_service.get_system_user_auth_info(self.system_user, self.asset)
+            get_system_user_auth_info(self.system_user, self.asset)
         if self.system_user.login_mode == MANUAL_LOGIN \
                 or (not password and not private_key):
             prompt = "{}'s password: ".format(self.system_user.username)
@@ -65,7 +66,13 @@ class ProxyServer:
             return True
         return False
 
-    def proxy(self):
+    def proxy(self, callback=None):
+        """
+        :param callback: if set and the bridge engine is enabled, return once
+                         the session started in the shared bridge loop, the
+                         callback is called after the session ended
+        :return: True if the session continues in the bridge engine
+        """
         if not self.check_protocol():
             return
         self.server = self.get_server_conn_from_cache()
@@ -84,9 +91,7 @@ class ProxyServer:
             self.server.close()
             return
 
-        try:
-            session.bridge()
-        finally:
+        def finish():
             Session.remove_session(session.id)
             self.server.close()
             msg = 'Session end, total {} now'.format(
@@ -94,6 +99,24 @@ class ProxyServer:
             )
             logger.info(msg)
 
+        def finish_and_callback():
+            try:
+                finish()
+            finally:
+                callback()
+
+        # 由共享的事件循环桥接, 当前线程不用等待会话结束
+        bridged_async = False
+        try:
+            if callback:
+                bridged_async = session.bridge_async(finish_and_callback)
+            if not bridged_async:
+                session.bridge()
+        finally:
+            if not bridged_async:
+                finish()
+        return bridged_async
+
     def validate_permission(self):
         """
         验证用户是否有连接改资产的权限
@@ -156,6 +179,10 @@ class ProxyServer:
             )
             if not conn or not conn.is_active:
                 return None
+            # 空闲保留的连接不经过 get_server_conn, 权限可能已被收回, 重新验证
+            elif not self.validate_permission():
+                conn.close()
+                return None
             else:
                 # 采用复用连接创建session时，系统用户用户名如果为空，创建session-400
                 self.system_user = conn.system_user
@@ -4,40 +4,175 @@
 
 import threading
 import datetime
+import queue
 import time
 import os
 import json
-from copy import deepcopy
+import gzip
+import zlib
+import codecs
 
-import jms_storage
+import pyte
 
 from .conf import config
-from .utils import get_logger, gzip_file
+from .utils import get_logger
 from .struct import MemoryQueue
-from .service import app_service
+from .spool import Spool
+from .storage import get_storage_client
+from .uploader import get_upload_manager
 
 logger = get_logger(__file__)
 BUF_SIZE = 1024
 
 
+class ReplayFrameEncoder(object):
+    """
+    Encode replay frames to the replay json format `"timedelta":"data",`.
+
+    Frames arrive within `window` seconds of the frame start are merged
+    into one, encoded frames are kept in memory and written out when the
+    buffer is over `buffer_size` or `flush_interval` seconds passed.
+    """
+    encode = staticmethod(json.encoder.encode_basestring_ascii)
+
+    def __init__(self, write, time_start, window=0.02,
+                 buffer_size=64*1024, flush_interval=10):
+        self.write = write
+        self.time_start = time_start
+        self.window = window
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.frame_time = None
+        self.frame_data = []
+        self.last_timedelta = None
+        self.parts = []
+        self.size = 0
+        self.last_flush = time_start
+
+    def add(self, timestamp, data):
+        if self.frame_time is None or timestamp - self.frame_time > self.window:
+            self.end_frame()
+            self.frame_time = timestamp
+        self.frame_data.append(data)
+        # 包括还未结束的帧
+        self.size += len(data)
+        if self.size >= self.buffer_size or \
+                timestamp - self.last_flush >= self.flush_interval:
+            self.end_frame()
+            self.flush()
+
+    def end_frame(self, final=False):
+        if not self.frame_data:
+            return
+        text = self.decoder.decode(b''.join(self.frame_data), final)
+        self.frame_data = []
+        frame_time, self.frame_time = self.frame_time, None
+        if not text:
+            return
+        timedelta = frame_time - self.time_start
+        # 时间相同的帧会成为重复的键, 后一个覆盖前一个
+        if self.last_timedelta is not None and \
+                timedelta <= self.last_timedelta:
+            timedelta = self.last_timedelta + 0.000001
+        self.last_timedelta = timedelta
+        self.parts.append('"{}":{},'.format(timedelta, self.encode(text)))
+
+    def flush(self, final=False):
+        self.end_frame(final=final)
+        self.last_flush = time.time()
+        if not self.parts:
+            return
+        self.write(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+
+
+class ReplayIndexer(object):
+    """
+    Keyframe index of a replay, a gzipped json lines sidecar.
+
+    The first line is the header, then every `interval` seconds a keyframe,
+    with the rendered screen, the cursor, and the offset of the next frame in
+    the uncompressed replay json (of the segment). The compressed stream is
+    fully flushed at each keyframe, so a player can seek the segment file to
+    `compressed_offset` and inflate from there (raw deflate, wbits=-15),
+    instead of decompressing from the beginning.
+    """
+
+    def __init__(self, path, interval, width=80, height=24):
+        self.path = path
+        self.interval = interval
+        self.next_time = 0
+        self.screen = pyte.Screen(width, height)
+        self.stream = pyte.ByteStream()
+        self.stream.attach(self.screen)
+        self.file = gzip.open(path + '.part', 'wt')
+        self.write_line({"version": 1, "interval": interval})
+
+    def write_line(self, data):
+        self.file.write(json.dumps(data) + '\n')
+
+    def due(self, timedelta):
+        return timedelta >= self.next_time
+
+    def keyframe(self, timedelta, segment, offset, compressed_offset):
+        self.write_line({
+            "time": timedelta,
+            "segment": segment,
+            "offset": offset,
+            "compressed_offset": compressed_offset,
+            "width": self.screen.columns,
+            "height": self.screen.lines,
+            "cursor": [self.screen.cursor.x, self.screen.cursor.y],
+            "screen": self.screen.display,
+        })
+        self.next_time = timedelta + self.interval
+
+    def feed(self, data):
+        try:
+            self.stream.feed(data)
+        except Exception as e:
+            logger.debug("Replay index feed error: {}".format(e))
+
+    def resize(self, width, height):
+        self.screen.resize(lines=height, columns=width)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.path + '.part', self.path)
+
+
 class ReplayRecorder(object):
+    """
+    Record the replay of a session.
+
+    If `REPLAY_SEGMENT_DURATION` or `REPLAY_SEGMENT_SIZE` is set, the replay
+    is rotated into segments `<session>.<index>.replay.gz`, each segment is a
+    complete replay json, uploaded when rotated, and a manifest
+    `<session>.manifest.json` links them.
+
+    If `REPLAY_INDEX_INTERVAL` is set, a keyframe index `<session>.index.gz`
+    is recorded too, see `ReplayIndexer`.
+    """
     time_start = None
     target = None
-    storage = None
     session_id = None
     filename = None
     file = None
     file_path = None
     filename_gz = None
     file_gz_path = None
-
-    def __init__(self):
-        self.get_storage()
-
-    def get_storage(self):
-        conf = deepcopy(config["REPLAY_STORAGE"])
-        conf["SERVICE"] = app_service
-        self.storage = jms_storage.get_object_storage(conf)
+    last_flush = 0
+    encoder = None
+    date = None
+    replay_dir = None
+    segment_index = 0
+    segment_start = None
+    segments = None
+    indexer = None
+    width = 80
+    height = 24
 
     def record(self, data):
         """
@@ -50,144 +185,369 @@ class ReplayRecorder(object):
         :return:
         """
         if len(data['data']) > 0:
-            timedelta = data['timestamp'] - self.time_start
-            data = json.dumps(data['data'].decode('utf-8', 'replace'))
-            self.file.write('"{}":{},'.format(timedelta, data))
+            if self.indexer:
+                self.index(data['timestamp'], data['data'])
+            self.encoder.add(data['timestamp'], data['data'])
+            if self.need_rotate():
+                self.rotate()
+
+    def write(self, s):
+        self.file.write(s.encode('utf-8'))
+        # 定期刷新压缩流, 进程崩溃时已写入的内容仍可解压
+        now = time.time()
+        if now - self.last_flush >= config['REPLAY_FLUSH_INTERVAL']:
+            self.file.flush()
+            self.last_flush = now
+
+    def index(self, timestamp, data):
+        timedelta = timestamp - self.time_start
+        if self.indexer.due(timedelta):
+            # 关键帧对应的屏幕不含本帧, 先写出缓冲, 本帧从 offset 处开始
+            self.encoder.flush()
+            # 完全刷新压缩流, 从压缩文件的 compressed_offset 处可以直接解压
+            self.file.flush(zlib.Z_FULL_FLUSH)
+            self.indexer.keyframe(
+                timedelta, self.segment_index, self.file.tell(),
+                self.file.fileobj.tell()
+            )
+        self.indexer.feed(data)
+
+    def resize(self, width, height):
+        self.width, self.height = width, height
+        if self.indexer:
+            self.indexer.resize(width, height)
+
+    @property
+    def segmented(self):
+        return bool(config['REPLAY_SEGMENT_DURATION'] or
+                    config['REPLAY_SEGMENT_SIZE'])
+
+    def need_rotate(self):
+        if not self.segmented:
+            return False
+        duration = config['REPLAY_SEGMENT_DURATION']
+        if duration and time.time() - self.segment_start >= duration:
+            return True
+        size = config['REPLAY_SEGMENT_SIZE']
+        # 压缩流有缓冲, 以压缩前的大小计算, 包括还在编码缓冲中的
+        if size and self.file.tell() + self.encoder.size >= size:
+            return True
+        return False
 
     def session_start(self, session_id):
         self.time_start = time.time()
         self.session_id = session_id
         self.filename = session_id
-        self.filename_gz = session_id + '.replay.gz'
-
-        date = datetime.datetime.utcnow().strftime('%Y-%m-%d')
-        replay_dir = os.path.join(config.REPLAY_DIR, date)
-        if not os.path.isdir(replay_dir):
-            os.makedirs(replay_dir, exist_ok=True)
-        # 录像记录路径
-        self.file_path = os.path.join(replay_dir, self.filename)
-        # 录像压缩到的路径
-        self.file_gz_path = os.path.join(replay_dir, self.filename_gz)
-        # 录像上传上去的路径
-        self.target = date + '/' + self.filename_gz
-        self.file = open(self.file_path, 'at')
-        self.file.write('{')
-
-    def session_end(self, session_id):
-        self.file.write('"0":""}')
-        self.file.close()
-        gzip_file(self.file_path, self.file_gz_path)
-        self.upload_replay_some_times()
-
-    def upload_replay_some_times(self, times=3):
-        # 如果上传OSS、S3失败则尝试上传到服务器
-        if times < 1:
-            if self.storage.type == 'jms':
-                return False
-            self.storage = jms_storage.JMSReplayStorage(
-                {"SERVICE": app_service}
+        self.segment_index = 0
+        self.segments = []
+
+        self.date = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        self.replay_dir = os.path.join(config.REPLAY_DIR, self.date)
+        if not os.path.isdir(self.replay_dir):
+            os.makedirs(self.replay_dir, exist_ok=True)
+        self.open_segment()
+        manager = get_upload_manager()
+        if self.segmented:
+            manager.register_recording(
+                self.session_id, self.manifest_path, self.manifest_target,
+                kind='manifest'
             )
-            self.upload_replay_some_times(times=3)
-
-        ok, msg = self.upload_replay()
-        if not ok:
-            msg = 'Failed push replay file {}: {}, try again {}'.format(
-                self.filename, msg, times
+        if config['REPLAY_INDEX_INTERVAL']:
+            self.indexer = ReplayIndexer(
+                self.index_path, config['REPLAY_INDEX_INTERVAL'],
+                width=self.width, height=self.height,
             )
-            logger.warn(msg)
-            self.upload_replay_some_times(times - 1)
-        else:
-            msg = 'Success push replay file: {}'.format(self.session_id)
-            logger.debug(msg)
-            return True
-
-    def upload_replay(self):
-        # 如果文件为空就直接删除
-        if not os.path.isfile(self.file_gz_path):
-            return False, 'Not found the file: {}'.format(self.file_gz_path)
-        if os.path.getsize(self.file_gz_path) == 0:
-            os.unlink(self.file_gz_path)
-            return True, ''
-        ok, msg = self.storage.upload(self.file_gz_path, self.target)
-        if ok:
-            self.finish_replay(3, self.session_id)
-            os.unlink(self.file_gz_path)
-        return ok, msg
-
-    def finish_replay(self, times, session_id):
-        if times < 1:
-            logger.error(
-                "Failed finished session {}'s replay".format(session_id)
+            manager.register_recording(
+                self.session_id, self.index_path, self.index_target,
+                finish=False, kind='index'
             )
-            return False
-
-        if app_service.finish_replay(session_id):
-            logger.debug(
-                "Success finished session {}'s replay ".format(session_id)
+        self.encoder = ReplayFrameEncoder(
+            self.write, self.time_start,
+            window=config['REPLAY_FRAME_WINDOW'] / 1000,
+            buffer_size=config['REPLAY_BUFFER_SIZE'],
+            flush_interval=config['REPLAY_FLUSH_INTERVAL'],
+        )
+
+    def open_segment(self):
+        if self.segmented:
+            self.filename_gz = '{}.{:04d}.replay.gz'.format(
+                self.session_id, self.segment_index
             )
-            return True
         else:
-            msg = "Failed finished session {}'s replay, try {} times"
-            logger.error(msg.format(session_id, times))
-            return self.finish_replay(times - 1, session_id)
+            self.filename_gz = self.session_id + '.replay.gz'
+        # 录像压缩到的路径
+        self.file_gz_path = os.path.join(self.replay_dir, self.filename_gz)
+        # 录像记录路径, 录制中的压缩文件, 结束后重命名
+        self.file_path = self.file_gz_path + '.part'
+        # 录像上传上去的路径
+        self.target = self.date + '/' + self.filename_gz
+        self.file = gzip.open(
+            self.file_path, 'wb',
+            compresslevel=config['REPLAY_COMPRESS_LEVEL']
+        )
+        # 登记到上传队列, 进程异常退出后可以修复并上传
+        get_upload_manager().register_recording(
+            self.session_id, self.file_gz_path, self.target,
+            finish=not self.segmented
+        )
+        self.segment_start = time.time()
+        self.last_flush = self.segment_start
+        self.write('{')
+
+    def close_segment(self):
+        self.file.write(b'"0":""}')
+        self.file.close()
+        os.rename(self.file_path, self.file_gz_path)
+        self.segments.append({
+            "index": self.segment_index,
+            "target": self.target,
+            "start": self.segment_start - self.time_start,
+            "end": time.time() - self.time_start,
+            "size": os.path.getsize(self.file_gz_path),
+        })
+        # 上传由后台队列完成, 这里只负责入队; 分段录像待清单上传后才完成
+        get_upload_manager().enqueue(
+            self.session_id, self.file_gz_path, self.target,
+            finish=not self.segmented
+        )
+
+    def rotate(self):
+        self.encoder.flush()
+        self.close_segment()
+        self.segment_index += 1
+        self.open_segment()
+        self.write_manifest()
+
+    @property
+    def index_path(self):
+        filename = self.session_id + '.index.gz'
+        return os.path.join(self.replay_dir, filename)
+
+    @property
+    def index_target(self):
+        return self.date + '/' + os.path.basename(self.index_path)
+
+    def close_index(self):
+        self.indexer.close()
+        get_upload_manager().enqueue(
+            self.session_id, self.index_path, self.index_target,
+            finish=False, kind='index'
+        )
+
+    @property
+    def manifest_path(self):
+        filename = self.session_id + '.manifest.json'
+        return os.path.join(self.replay_dir, filename)
+
+    @property
+    def manifest_target(self):
+        return self.date + '/' + os.path.basename(self.manifest_path)
+
+    def write_manifest(self, finished=False):
+        manifest = {
+            "version": 1,
+            "session": self.session_id,
+            "date_start": self.time_start,
+            "finished": finished,
+            "segments": self.segments,
+        }
+        if self.indexer:
+            manifest["index"] = self.index_target
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.manifest_path)
+
+    def session_end(self, session_id):
+        self.encoder.flush(final=True)
+        self.close_segment()
+        if self.indexer:
+            self.close_index()
+        if not self.segmented:
+            return
+        self.write_manifest(finished=True)
+        manager = get_upload_manager()
+        # 所有分段上传后再上传清单, 完成录像
+        depends = [manager.get_job_id(seg['target']) for seg in self.segments]
+        manager.enqueue(
+            self.session_id, self.manifest_path, self.manifest_target,
+            depends=depends, kind='manifest'
+        )
 
 
 class CommandRecorder(object):
-    batch_size = 10
-    timeout = 5
-    no = 0
-    storage = None
-    _cache = []
-
-    def __init__(self):
-        super(CommandRecorder, self).__init__()
-        self.queue = MemoryQueue()
-        self.stop_evt = threading.Event()
-        self.push_to_server_async()
-        self.get_storage()
+    """
+    Process wide command recorder, commands of all the sessions are put in
+    one queue, workers take them out by batch, which is full or waited for
+    `COMMAND_BATCH_LINGER` seconds, and bulk save them, each worker holds
+    a storage client from the shared pool.
+
+    When the storage is unavailable or the queue is full, commands are
+    written to the disk spool, and replayed after the storage recovered.
+    """
+    retry_interval = 10
+
+    def __init__(self, workers=1, batch_size=10, linger=1, queue_size=0,
+                 spool=None, replay_rate=0):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = MemoryQueue(maxsize=queue_size)
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.healthy = True
+        self.saved = 0
+        self.failed = 0
+        self.spooled = 0
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self.push_to_server,
+                name='command-recorder-{}'.format(i)
+            )
+            thread.daemon = True
+            thread.start()
+        if self.spool:
+            thread = threading.Thread(
+                target=self.replay_spool, name='command-spool'
+            )
+            thread.daemon = True
+            thread.start()
 
     def record(self, data):
         if data and data['input']:
             data['input'] = data['input'][:128]
             data['output'] = data['output'][:1024]
             data['timestamp'] = int(data['timestamp'])
-            self.queue.put(data)
-
-    def get_storage(self):
-        conf = deepcopy(config["COMMAND_STORAGE"])
-        conf['SERVICE'] = app_service
-        self.storage = jms_storage.get_log_storage(conf)
-
-    def push_to_server_async(self):
-        def func():
-            while True:
-                if self.stop_evt.is_set() and self.queue.empty():
-                    break
-                data_set = self.queue.mget(self.batch_size, timeout=self.timeout)
-                size = self.queue.qsize()
-                if size > 0:
-                    logger.debug("Session command remain push: {}".format(size))
-                if not data_set:
-                    continue
-                logger.debug("Send {} commands to server".format(len(data_set)))
-                for i in range(5):
-                    ok = self.storage.bulk_save(data_set)
-                    if ok:
-                        break
-
-        thread = threading.Thread(target=func)
-        thread.daemon = True
-        thread.start()
+            if self.spool is None:
+                self.queue.put(data)
+                return
+            # 存储不可用时直接落盘, 内存队列不再增长
+            if not self.healthy:
+                self.spool_commands([data])
+                return
+            try:
+                self.queue.put_nowait(data)
+            except queue.Full:
+                self.spool_commands([data])
+
+    def spool_commands(self, data_set):
+        try:
+            self.spool.append(data_set)
+            self.spooled += len(data_set)
+        except OSError as e:
+            self.failed += len(data_set)
+            logger.error("Spool {} commands failed: {}".format(
+                len(data_set), e
+            ))
+
+    @staticmethod
+    def bulk_save(data_set):
+        # 存储异常(如 ES 连接失败)按保存失败处理
+        try:
+            with get_storage_client('command') as storage:
+                return storage.bulk_save(data_set)
+        except Exception as e:
+            logger.error("Bulk save commands error: {}".format(e))
+            logger.debug(e, exc_info=True)
+            return False
+
+    def push_to_server(self):
+        # 所有会话共用的线程, 不能因为异常退出
+        while True:
+            try:
+                self.push_batch()
+            except Exception as e:
+                logger.error("Push commands error: {}".format(e))
+                logger.error(e, exc_info=True)
+                time.sleep(1)
+
+    def push_batch(self):
+        data_set = self.queue.mget(
+            self.batch_size, timeout=5, linger=self.linger
+        )
+        size = self.queue.qsize()
+        if size > 0:
+            logger.debug("Session command remain push: {}".format(size))
+        if not data_set:
+            return
+        logger.debug("Send {} commands to server".format(len(data_set)))
+        # 已知存储不可用时不再反复重试
+        times = 5 if self.healthy else 1
+        for i in range(times):
+            ok = self.bulk_save(data_set)
+            if ok:
+                self.saved += len(data_set)
+                return
+        logger.error("Send {} commands to server failed".format(
+            len(data_set)
+        ))
+        if self.spool is None:
+            self.failed += len(data_set)
+            return
+        self.healthy = False
+        self.spool_commands(data_set)
+
+    def replay_spool(self):
+        def save(data_set):
+            ok = self.bulk_save(data_set)
+            if ok:
+                self.saved += len(data_set)
+                self.spooled -= len(data_set)
+            return ok
+
+        while True:
+            time.sleep(self.retry_interval)
+            if not self.spool.has_pending():
+                continue
+            try:
+                self.healthy = self.spool.replay(
+                    save, batch_size=self.batch_size * 10,
+                    rate=self.replay_rate
+                )
+            except Exception as e:
+                logger.error("Replay command spool error: {}".format(e))
+                logger.error(e, exc_info=True)
+            if self.healthy:
+                logger.info("Replay command spool finished")
 
     def session_start(self, session_id):
         pass
 
     def session_end(self, session_id):
-        self.stop_evt.set()
+        pass
+
+    def get_stats(self):
+        return {
+            "queue_size": self.queue.qsize(),
+            "healthy": self.healthy,
+            "saved": self.saved,
+            "failed": self.failed,
+            "spooled": self.spooled,
+        }
+
+
+_command_recorder = None
+_command_recorder_lock = threading.Lock()
 
 
 def get_command_recorder():
-    return CommandRecorder()
+    global _command_recorder
+    with _command_recorder_lock:
+        if _command_recorder is None:
+            spool = None
+            if config['COMMAND_SPOOL_DIR']:
+                spool = Spool(
+                    config['COMMAND_SPOOL_DIR'],
+                    segment_size=config['COMMAND_SPOOL_SEGMENT_SIZE'],
+                )
+            _command_recorder = CommandRecorder(
+                workers=config['COMMAND_RECORD_WORKERS'],
+                batch_size=config['COMMAND_BATCH_SIZE'],
+                linger=config['COMMAND_BATCH_LINGER'],
+                queue_size=config['COMMAND_QUEUE_SIZE'],
+                spool=spool,
+                replay_rate=config['COMMAND_SPOOL_REPLAY_RATE'],
+            )
+    return _command_recorder
 
 
 def get_replay_recorder():
@@ -13,10 +13,15 @@ except ImportError:
 from .utils import get_logger, wrap_with_warning as warn, \
     wrap_with_line_feed as wr, ugettext as _, ignore_error
 from .service import app_service
-from .struct import SelectEvent
+from .struct import SelectEvent, RateMeter
 from .recorder import get_recorder
+from .models import SubscriberWriter, NonBlockingWriter, ZMODEM_BUF_SIZE
+from .bridge import get_bridge_engine
+from .conf import config
 
 BUF_SIZE = 1024
+MAX_BUF_SIZE = 32 * 1024
+MAX_COALESCE_SIZE = 64 * 1024
 logger = get_logger(__file__)
 
 
@@ -29,17 +34,32 @@ class Session:
         self.server = server  # Server channel
         self._watchers = []  # Only watch session
         self._sharers = []  # Join to the session, read and write
+        self._writers = {}  # Watcher or sharer => it's SubscriberWriter
         self.replaying = True
         self.date_start = datetime.datetime.utcnow()
         self.date_end = None
         self.is_finished = False
         self.closed = False
-        self.sel = selectors.DefaultSelector()
+        if config.BRIDGE_ENGINE:
+            self._bridge_engine = get_bridge_engine()
+            self.sel = self._bridge_engine.new_selector(self)
+            # 共享的事件循环中不能阻塞, 发不完的数据由事件循环稍后发送
+            self._client_writer = NonBlockingWriter(self.client)
+            self._server_writer = NonBlockingWriter(self.server.chan)
+        else:
+            self._bridge_engine = None
+            self.sel = selectors.DefaultSelector()
+            self._client_writer = None
+            self._server_writer = None
         self._command_recorder = None
         self._replay_recorder = None
         self.stop_evt = SelectEvent()
         self.server.set_session(self)
         self.date_last_active = datetime.datetime.utcnow()
+        self._buf_size = BUF_SIZE
+        self.output_meter = RateMeter()  # Server to client
+        self.input_meter = RateMeter()  # Client to server
+        self._event_listeners = {}
 
     @classmethod
     def new_session(cls, client, server):
@@ -68,7 +88,6 @@ class Session:
         if session:
             session.close()
             app_service.finish_session(session.to_json())
-            app_service.finish_replay(sid)
             cls.sessions.pop(sid, None)
 
     def add_watcher(self, watcher, silent=False):
@@ -83,12 +102,14 @@ class Session:
         if not silent:
             watcher.send_unicode("Welcome to watch session {}\r\n".format(self.id))
         self.sel.register(watcher, selectors.EVENT_READ)
+        self._writers[watcher] = SubscriberWriter(watcher)
         self._watchers.append(watcher)
 
     def remove_watcher(self, watcher):
         logger.debug("Session %s remove watcher %s" % (self.id, watcher))
         self.sel.unregister(watcher)
         self._watchers.remove(watcher)
+        self._remove_writer(watcher)
 
     def add_sharer(self, sharer, silent=False):
         """
@@ -102,27 +123,67 @@ class Session:
             sharer.send("Welcome to join session: {}\r\n"
                         .format(self.id).encode("utf-8"))
         self.sel.register(sharer, selectors.EVENT_READ)
+        self._writers[sharer] = SubscriberWriter(sharer)
         self._sharers.append(sharer)
 
     @property
     def closed_unexpected(self):
         return not self.is_finished and (self.client.closed or self.server.closed)
 
+    @property
+    def is_alive(self):
+        return not self.client.closed and not self.server.closed
+
     def remove_sharer(self, sharer):
         logger.info("Session %s remove sharer %s" % (self.id, sharer))
-        sharer.send("Leave session {} at {}"
-                    .format(self.id, datetime.datetime.now())
-                    .encode("utf-8"))
+        msg = "Leave session {} at {}".format(
+            self.id, datetime.datetime.now()
+        ).encode("utf-8")
+        # 经过写线程发送, 在已缓冲的输出之后
+        writer = self._writers.get(sharer)
+        if writer:
+            writer.send(msg)
+        else:
+            sharer.send(msg)
+        self._remove_writer(sharer)
         self.sel.unregister(sharer)
         self._sharers.remove(sharer)
 
+    def add_event_listener(self, event, func):
+        """
+        Listen session events, see `const.SESSION_EVENT_*`
+
+        :param event: event name
+        :param func: called with (session, event, **kwargs)
+        """
+        self._event_listeners.setdefault(event, []).append(func)
+
+    def remove_event_listener(self, event, func):
+        listeners = self._event_listeners.get(event, [])
+        if func in listeners:
+            listeners.remove(func)
+
+    def fire_event(self, event, **kwargs):
+        logger.debug("Session {} event: {} {}".format(self.id, event, kwargs))
+        for func in list(self._event_listeners.get(event, [])):
+            try:
+                func(self, event, **kwargs)
+            except Exception as e:
+                logger.error("Session event listener error: {}".format(e))
+                logger.error(e, exc_info=True)
+
+    def _remove_writer(self, subscriber):
+        writer = self._writers.pop(subscriber, None)
+        if writer:
+            writer.close()
+
     def set_command_recorder(self, recorder):
         self._command_recorder = recorder
 
     def set_replay_recorder(self, recorder):
         self._replay_recorder = recorder
 
-    def put_command(self, _input, _output):
+    def put_command(self, _input, _output, timestamp=None):
         self._command_recorder.record({
             "session": self.id,
             "org_id": self.server.asset.org_id,
@@ -132,7 +193,7 @@ class Session:
                                      self.client.user.username),
             "asset": self.server.asset.hostname,
             "system_user": self.server.system_user.username,
-            "timestamp": time.time(),
+            "timestamp": timestamp or time.time(),
         })
 
     def put_replay(self, data):
@@ -143,6 +204,10 @@ class Session:
         })
 
     def pre_bridge(self):
+        meta = self.client.request.meta
+        self._replay_recorder.resize(
+            meta.get('width', 80), meta.get('height', 24)
+        )
         self._replay_recorder.session_start(self.id)
         self._command_recorder.session_start(self.id)
 
@@ -159,9 +224,39 @@ class Session:
             pass
         self.stop_evt.set()
 
+    def send_to_subscribers(self, data):
+        for writer in list(self._writers.values()):
+            writer.send(data)
+
     def send_to_clients(self, data):
-        for watcher in [self.client] + self._watchers + self._sharers:
-            watcher.send(data)
+        if self._client_writer:
+            self._client_writer.write(data)
+        else:
+            self.client.send(data)
+        self.send_to_subscribers(data)
+
+    def send_to_server(self, data):
+        if self._server_writer:
+            self._server_writer.write(self.server.filter_send(data))
+        else:
+            self.server.send(data)
+
+    @property
+    def output_pending(self):
+        return bool(self._client_writer and (
+            self._client_writer.pending or self._server_writer.pending
+        ))
+
+    def flush(self):
+        """
+        Send the data kept by the bridge engine, and resume reading the
+        paused side once its peer drained
+        """
+        for writer, source in ((self._client_writer, self.server),
+                               (self._server_writer, self.client)):
+            writer.flush()
+            if not writer.full:
+                self.sel.resume(source)
 
     def bridge(self):
         """
@@ -170,57 +265,139 @@ class Session:
         """
         logger.info("Start bridge session: {}".format(self.id))
         self.pre_bridge()
+        self._register()
+        if self._bridge_engine:
+            # 由共享的事件循环处理, 这里只等待结束
+            self.sel.wait()
+        else:
+            while not self.is_finished:
+                events = self.sel.select(timeout=60)
+                if not self.is_alive:
+                    break
+                for sock in [key.fileobj for key, _ in events]:
+                    self.handle_event(sock)
+                    if self.is_finished:
+                        break
+            self.sel.close()
+        logger.debug("Session stop event set: {}".format(self.id))
+
+    def bridge_async(self, callback):
+        """
+        Bridge in the shared bridge engine without waiting in this thread,
+        `callback` is called in a new thread after the session ended.
+
+        :return: False if the bridge engine is disabled
+        """
+        if not self._bridge_engine:
+            return False
+        logger.info("Start bridge session: {}".format(self.id))
+        self.pre_bridge()
+        self.sel.set_callback(callback)
+        self._register()
+        return True
+
+    def _register(self):
         self.sel.register(self.client, selectors.EVENT_READ)
         self.sel.register(self.server, selectors.EVENT_READ)
         self.sel.register(self.stop_evt, selectors.EVENT_READ)
         self.sel.register(self.client.change_size_evt, selectors.EVENT_READ)
-        while not self.is_finished:
-            events = self.sel.select(timeout=60)
-            if self.client.closed:
-                break
-            if self.server.closed:
-                break
-            for sock in [key.fileobj for key, _ in events]:
-                data = sock.recv(BUF_SIZE)
-                if sock == self.server:
-                    if len(data) == 0:
-                        msg = "Server close the connection"
-                        logger.info(msg)
-                        self.is_finished = True
-                        break
 
-                    self.date_last_active = datetime.datetime.utcnow()
-                    for watcher in [self.client] + self._watchers + self._sharers:
-                        watcher.send(data)
-                elif sock == self.client:
-                    if len(data) == 0:
-                        msg = "Client close the connection: {}".format(self.client)
-                        logger.info(msg)
-                        for watcher in self._watchers + self._sharers:
-                            watcher.send(msg.encode("utf-8"))
-                        self.is_finished = True
-                        break
-                    self.server.send(data)
-                elif sock == self.stop_evt:
-                    self.is_finished = True
-                    break
-                elif sock == self.client.change_size_evt:
-                    self.resize_win_size()
-        logger.debug("Session stop event set: {}".format(self.id))
+    def handle_event(self, sock):
+        in_zmodem = self.server.in_zmodem
+        if sock == self.server:
+            if in_zmodem:
+                data = self.server.recv(ZMODEM_BUF_SIZE)
+            else:
+                data = self.server.recv(
+                    self._buf_size,
+                    window=config['BRIDGE_COALESCE_WINDOW'] / 1000,
+                    max_size=MAX_COALESCE_SIZE,
+                    # 共享的事件循环中不等待
+                    wait=self._bridge_engine is None,
+                )
+            if len(data) == 0:
+                msg = "Server close the connection"
+                logger.info(msg)
+                self.is_finished = True
+                return
+
+            if not in_zmodem:
+                self.adapt_buf_size(len(data))
+            self.output_meter.add(len(data))
+            self.date_last_active = datetime.datetime.utcnow()
+            self.send_to_clients(data)
+            # 客户端接收慢, 暂停读取服务器, 不再占用内存
+            if self._client_writer and self._client_writer.full:
+                self.sel.pause(self.server)
+            return
+
+        if sock == self.client and in_zmodem:
+            data = sock.recv(ZMODEM_BUF_SIZE)
+        else:
+            data = sock.recv(BUF_SIZE)
+        if sock == self.client:
+            if len(data) == 0:
+                msg = "Client close the connection: {}".format(self.client)
+                logger.info(msg)
+                self.send_to_subscribers(msg.encode("utf-8"))
+                self.is_finished = True
+                return
+            self.input_meter.add(len(data))
+            self.send_to_server(data)
+            if self._server_writer and self._server_writer.full:
+                self.sel.pause(self.client)
+        elif sock == self.stop_evt:
+            self.is_finished = True
+        elif sock == self.client.change_size_evt:
+            self.resize_win_size()
+
+    def adapt_buf_size(self, size):
+        """
+        Grow the read size under sustained output, shrink it for
+        interactive echo
+        """
+        if size >= self._buf_size:
+            self._buf_size = min(self._buf_size * 2, MAX_BUF_SIZE)
+        elif size < self._buf_size // 4:
+            self._buf_size = max(self._buf_size // 2, BUF_SIZE)
+
+    def get_stats(self):
+        return {
+            "id": self.id,
+            "output": self.output_meter.to_json(),
+            "input": self.input_meter.to_json(),
+            "buf_size": self._buf_size,
+            "zmodem_transfers": self.server.zmodem_transfers,
+        }
 
     def resize_win_size(self):
         width, height = self.client.request.meta['width'], \
                         self.client.request.meta['height']
         logger.debug("Resize server chan size {}*{}".format(width, height))
         self.server.resize_pty(width=width, height=height)
+        self._replay_recorder.resize(width, height)
 
     def close(self):
         if self.closed:
             logger.debug("Session has been closed: {} ".format(self.id))
             return
         logger.info("Close the session: {} ".format(self.id))
+        logger.info("Session {} stats: {}".format(self.id, self.get_stats()))
         self.is_finished = True
         self.closed = True
+        if self._bridge_engine:
+            self.sel.close()
+            for writer in (self._client_writer, self._server_writer):
+                # 尽量发送剩余的数据, 不等待
+                try:
+                    writer.flush()
+                except (OSError, EOFError) as e:
+                    logger.debug("Flush session {} error: {}".format(
+                        self.id, e
+                    ))
+                writer.close()
+        for subscriber in list(self._writers):
+            self._remove_writer(subscriber)
         self.post_bridge()
         self.date_end = datetime.datetime.utcnow()
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import json
+import time
+import zlib
+import threading
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+
+class Spool(object):
+    """
+    An append-only spool on local disk, items are appended by batch, one
+    batch one line `<crc32> <json>`, to segment files. Segments are replayed
+    oldest first, lines with a wrong checksum, such as a torn write when
+    crashed, are skipped.
+    """
+    suffix = '.seg'
+
+    def __init__(self, spool_dir, segment_size=4*1024*1024):
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_path = None
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def new_segment_path(self):
+        # 按微秒时间命名, 文件名排序即写入顺序
+        ts = int(time.time() * 1000000)
+        while True:
+            filename = '{:020d}{}'.format(ts, self.suffix)
+            path = os.path.join(self.spool_dir, filename)
+            if not os.path.exists(path):
+                return path
+            ts += 1
+
+    def segments(self):
+        return sorted(
+            os.path.join(self.spool_dir, f)
+            for f in os.listdir(self.spool_dir) if f.endswith(self.suffix)
+        )
+
+    def _rotate(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.file_path = None
+
+    @staticmethod
+    def encode(items):
+        data = json.dumps(items).encode('utf-8')
+        return '{:08x} '.format(zlib.crc32(data)).encode() + data + b'\n'
+
+    def append(self, items):
+        if not items:
+            return
+        line = self.encode(items)
+        with self.lock:
+            if self.file is None:
+                self.file_path = self.new_segment_path()
+                self.file = open(self.file_path, 'ab')
+            self.file.write(line)
+            self.file.flush()
+            if self.file.tell() >= self.segment_size:
+                self._rotate()
+
+    def has_pending(self):
+        with self.lock:
+            if self.file is not None:
+                return True
+        return bool(self.segments())
+
+    @staticmethod
+    def read_segment(path):
+        batches = []
+        with open(path, 'rb') as f:
+            for n, line in enumerate(f):
+                crc, _, data = line.rstrip(b'\n').partition(b' ')
+                try:
+                    if int(crc, 16) != zlib.crc32(data):
+                        raise ValueError('checksum mismatch')
+                    batches.append(json.loads(data.decode('utf-8')))
+                except ValueError as e:
+                    logger.error("Skip broken spool record {}:{}: {}".format(
+                        path, n, e
+                    ))
+        return batches
+
+    def write_segment(self, path, batches):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for items in batches:
+                f.write(self.encode(items))
+        os.rename(tmp_path, path)
+
+    def replay(self, save, batch_size=100, rate=0):
+        """
+        Replay the spooled items oldest first.
+
+        :param save: func(items) -> bool, stop replaying when it failed
+        :param batch_size: max items saved once
+        :param rate: max items saved per second, 0 not limit
+        :return: True if all replayed
+        """
+        # 正在写的段也要回放, 先切换到新段, 并在锁内确定要回放的段,
+        # 之后 append 新建的段不在其中
+        with self.lock:
+            self._rotate()
+            segments = [p for p in self.segments() if p != self.file_path]
+        for path in segments:
+            batches = self.read_segment(path)
+            items = [item for batch in batches for item in batch]
+            while items:
+                chunk = items[:batch_size]
+                start = time.time()
+                if not save(chunk):
+                    # 保留没有回放的部分, 稍后再试
+                    self.write_segment(path, [items])
+                    return False
+                items = items[batch_size:]
+                if rate:
+                    wait = len(chunk) / rate - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+            os.unlink(path)
+        return True
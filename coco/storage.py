@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import json
+import queue
+import hashlib
+import threading
+from copy import deepcopy
+from contextlib import contextmanager
+
+import jms_storage
+
+from .conf import config
+from .service import app_service
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+
+def new_replay_storage(conf):
+    return jms_storage.get_object_storage(conf)
+
+
+def new_command_storage(conf):
+    return jms_storage.get_log_storage(conf)
+
+
+def new_server_replay_storage(conf):
+    return jms_storage.JMSReplayStorage(conf)
+
+
+# 存储类别: (配置名, 创建客户端的方法)
+STORAGE_KINDS = {
+    'replay': ('REPLAY_STORAGE', new_replay_storage),
+    'command': ('COMMAND_STORAGE', new_command_storage),
+    # 上传到 OSS、S3 多次失败后改为上传到服务器
+    'replay_server': (None, new_server_replay_storage),
+}
+
+
+class StoragePool(object):
+    """
+    Clients of one storage config, created when needed, at most `size`
+    ones, and reused by all the threads.
+    """
+
+    def __init__(self, factory, conf, size=4):
+        self.factory = factory
+        self.conf = conf
+        self.size = size
+        self.clients = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.clients.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.clients.get()
+        try:
+            conf = deepcopy(self.conf)
+            conf['SERVICE'] = app_service
+            return self.factory(conf)
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, client):
+        self.clients.put(client)
+
+
+class StorageRegistry(object):
+    """
+    Process wide storage clients, pooled by kind and the hash of the
+    storage config, when the config changed, such as loaded from server,
+    the clients are rebuilt.
+    """
+
+    def __init__(self):
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_conf(kind):
+        name = STORAGE_KINDS[kind][0]
+        if name is None:
+            return {}
+        return config[name] or {}
+
+    @staticmethod
+    def hash_conf(conf):
+        data = json.dumps(conf, sort_keys=True, default=str)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    def get_pool(self, kind):
+        conf = self.get_conf(kind)
+        key = self.hash_conf(conf)
+        pool_key, pool = self.pools.get(kind, (None, None))
+        if pool_key == key:
+            return pool
+        with self.lock:
+            pool_key, pool = self.pools.get(kind, (None, None))
+            if pool_key != key:
+                if pool is not None:
+                    logger.info("Storage {} config changed, rebuild the "
+                                "clients".format(kind))
+                pool = StoragePool(
+                    STORAGE_KINDS[kind][1], conf,
+                    size=config['STORAGE_POOL_SIZE']
+                )
+                self.pools[kind] = (key, pool)
+            return pool
+
+    @contextmanager
+    def client(self, kind):
+        pool = self.get_pool(kind)
+        storage = pool.acquire()
+        try:
+            yield storage
+        finally:
+            pool.release(storage)
+
+    def refresh(self):
+        """
+        Drop the clients of changed config now, instead of the next use
+        """
+        for kind in list(self.pools.keys()):
+            self.get_pool(kind)
+
+
+storage_registry = StorageRegistry()
+
+
+def get_storage_client(kind):
+    """
+    with get_storage_client('replay') as storage:
+        storage.upload(path, target)
+    """
+    return storage_registry.client(kind)
@@ -2,18 +2,40 @@
 # -*- coding: utf-8 -*-
 #
 
+import re
 import queue
 import socket
+import time
+import threading
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
 
 
 class MultiQueueMixin:
-    def mget(self, size=1, block=True, timeout=5):
+    def mget(self, size=1, block=True, timeout=5, linger=0):
+        """
+        Get a batch of items: wait for the first one at most `timeout`
+        seconds, then take the ready ones, and wait for more at most
+        `linger` seconds, until `size` items got.
+        """
         items = []
-        for i in range(size):
-            try:
-                items.append(self.get(block=block, timeout=timeout))
-            except queue.Empty:
-                break
+        try:
+            items.append(self.get(block=block, timeout=timeout))
+        except queue.Empty:
+            return items
+        deadline = time.monotonic() + linger
+        with self.not_empty:
+            while len(items) < size:
+                if not self._qsize():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+                    continue
+                items.append(self._get())
+                self.not_full.notify()
         return items
 
     def mput(self, data_set):
@@ -25,32 +47,155 @@ class MemoryQueue(MultiQueueMixin, queue.Queue, object):
     pass
 
 
-class SizedList(list):
-    def __init__(self, maxsize=0):
-        self.maxsize = maxsize
-        self.size = 0
-        self.end_with_ascii = False
-        super(list, self).__init__()
+class WorkerPool:
+    """
+    A fixed number of worker threads, each one has a bounded queue.
+    Tasks with the same key always run on the same worker, so they keep
+    their order.
+    """
+    def __init__(self, workers=2, maxsize=1000, name='worker'):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(workers)]
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run, args=(q,), name='{}-{}'.format(name, i)
+            )
+            thread.daemon = True
+            thread.start()
 
-    def is_full(self):
-        if self.maxsize == 0:
-            return False
-        if not self.end_with_ascii:
+    @staticmethod
+    def _run(q):
+        while True:
+            func, args, kwargs = q.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        :return: False if the worker's queue is full
+        """
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put_nowait((func, args, kwargs))
+        except queue.Full:
             return False
-        if self.size >= self.maxsize:
-            return True
+        return True
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+
+class StreamScanner:
+    """
+    Find several byte marks in a stream with one pass over each chunk,
+    keep a tail of the last chunk, so marks straddle chunk boundaries are
+    found too.
+
+    scanner = StreamScanner({'end': b'**\x18B08'})
+    scanner.scan(b'..**\x18') => []
+    scanner.scan(b'B08..') => ['end']
+    """
+    def __init__(self, marks):
+        self.names = {mark: name for name, mark in marks.items()}
+        patterns = sorted(self.names, key=len, reverse=True)
+        self.pattern = re.compile(b'|'.join(re.escape(p) for p in patterns))
+        self.keep = max(len(p) for p in patterns) - 1
+        self.tail = b''
+
+    def scan(self, data):
+        """
+        :return: names of the found marks, in the order they appear
+        """
+        found = []
+        tail = self.tail
+        if tail:
+            # 只查找跨越两个数据块的标记
+            junction = tail + data[:self.keep]
+            for m in self.pattern.finditer(junction):
+                if m.start() < len(tail) < m.end():
+                    found.append(self.names[m.group()])
+        for m in self.pattern.finditer(data):
+            found.append(self.names[m.group()])
+        if not self.keep:
+            self.tail = b''
+        elif len(data) >= self.keep:
+            self.tail = data[len(data)-self.keep:]
         else:
-            return False
+            self.tail = (tail + data)[-self.keep:]
+        return found
+
+    def reset(self):
+        self.tail = b''
+
+
+class RingBuffer:
+    """
+    A preallocated bytearray ring buffer, keep the last `maxsize` bytes,
+    memory is fixed, readers get memoryview of it with no copy.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.buf = bytearray(maxsize)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.size = 0
+        self.overwritten = False
 
     def append(self, b):
-        if not self.is_full() and b:
-            super(SizedList, self).append(b)
-            self.size += len(b)
-            self.end_with_ascii = b[-1] <= 126
+        n = len(b)
+        if not n:
+            return
+        maxsize = self.maxsize
+        if n >= maxsize:
+            self.view[:] = b[n-maxsize:]
+            self.start = 0
+            self.size = maxsize
+            self.overwritten = True
+            return
+        end = (self.start + self.size) % maxsize
+        first = min(n, maxsize - end)
+        self.view[end:end+first] = b[:first]
+        if first < n:
+            self.view[:n-first] = b[first:]
+        overflow = self.size + n - maxsize
+        if overflow > 0:
+            self.start = (self.start + overflow) % maxsize
+            self.size = maxsize
+            self.overwritten = True
+        else:
+            self.size += n
+
+    def views(self):
+        """
+        :return: memoryview list of the data, oldest first
+        """
+        if not self.size:
+            return []
+        start, end = self.start, self.start + self.size
+        if end <= self.maxsize:
+            parts = [self.view[start:end]]
+        else:
+            parts = [self.view[start:], self.view[:end-self.maxsize]]
+        if self.overwritten:
+            # 跳过被截断的 utf-8 字符的后续字节
+            head = parts[0]
+            skip = 0
+            while skip < min(3, len(head)) and 0x80 <= head[skip] < 0xc0:
+                skip += 1
+            parts[0] = head[skip:]
+        return parts
+
+    def getvalue(self):
+        return b''.join(self.views())
 
     def clean(self):
+        self.start = 0
         self.size = 0
-        del self[:]
+        self.overwritten = False
+
+    def __len__(self):
+        return self.size
 
 
 class SelectEvent:
@@ -65,3 +210,149 @@ class SelectEvent:
 
     def __getattr__(self, item):
         return getattr(self.p1, item)
+
+
+class RateMeter:
+    """
+    Count bytes, and compute the average and the last second's rate
+    """
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.total = 0
+        self.date_start = time.time()
+        self.rate = 0
+        self.peak_rate = 0
+        self._window_start = self.date_start
+        self._window_bytes = 0
+
+    def add(self, n):
+        self.total += n
+        self._window_bytes += n
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed >= self.interval:
+            self.rate = self._window_bytes / elapsed
+            self.peak_rate = max(self.peak_rate, self.rate)
+            self._window_start = now
+            self._window_bytes = 0
+
+    @property
+    def avg_rate(self):
+        elapsed = time.time() - self.date_start
+        if elapsed <= 0:
+            return 0
+        return self.total / elapsed
+
+    def to_json(self):
+        return {
+            "bytes": self.total,
+            "rate": round(self.rate, 2),
+            "avg_rate": round(self.avg_rate, 2),
+            "peak_rate": round(self.peak_rate, 2),
+        }
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    A cache whose items expire after ttl seconds. Concurrent loads of the
+    same missing key are merged into one (singleflight), the others wait
+    for and share its result.
+    """
+    def __init__(self, ttl=60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item and item[1] > time.time():
+            return item[0]
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            if key not in self.data and len(self.data) >= self.maxsize:
+                self._purge()
+            self.data[key] = (value, time.time() + ttl)
+
+    def _purge(self):
+        now = time.time()
+        for k in [k for k, v in self.data.items() if v[1] <= now]:
+            del self.data[k]
+        # 仍然满了, 删除最早加入的
+        while len(self.data) >= self.maxsize:
+            del self.data[next(iter(self.data))]
+
+    def get_or_load(self, key, loader, ttl=None, cache_if=None):
+        """
+        :param loader: func() -> value, called when missed
+        :param ttl: ttl of this item, default self.ttl
+        :param cache_if: func(value) -> bool, cache the value or not,
+                         default not cache None
+        """
+        with self.lock:
+            item = self.data.get(key)
+            if item and item[1] > time.time():
+                self.hits += 1
+                return item[0]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.waits += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+        try:
+            value = loader()
+            flight.value = value
+            cacheable = cache_if(value) if cache_if else value is not None
+            if cacheable:
+                self.set(key, value, ttl=ttl)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.event.set()
+
+    def invalidate(self, *prefix):
+        """
+        Remove the items whose key starts with prefix, keys are tuple, no
+        prefix remove all
+        """
+        with self.lock:
+            if not prefix:
+                self.data.clear()
+                return
+            n = len(prefix)
+            for k in list(self.data.keys()):
+                if isinstance(k, tuple) and k[:n] == prefix:
+                    del self.data[k]
+
+    def to_json(self):
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+        }
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import re
+import json
+import time
+import gzip
+import zlib
+import heapq
+import threading
+import itertools
+
+from .conf import config
+from .service import app_service
+from .storage import get_storage_client
+from .utils import get_logger
+
+logger = get_logger(__file__)
+# 不匹配录制中的 .part 文件, 崩溃遗留的由登记的录制任务修复
+session_file_pattern = re.compile(
+    r'^(?P<session>[0-9a-f-]{36})'
+    r'(?P<suffix>(\.\d{4})?\.replay\.gz|\.index\.gz)?$'
+)
+segment_pattern = re.compile(r'^[0-9a-f-]{36}\.(?P<index>\d{4})\.replay\.gz$')
+
+
+def read_gzip_tolerant(path):
+    """
+    Read a gzip file may be truncated, such as recording when crashed,
+    return the data could be decompressed.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(64 * 1024)
+            if not block:
+                break
+            try:
+                chunks.append(decompressor.decompress(block))
+            except zlib.error:
+                break
+    return b''.join(chunks)
+
+
+def repair_replay_text(text):
+    """
+    Keep the complete frames `"timedelta":"data",` of a broken replay json,
+    and close it.
+    """
+    decoder = json.JSONDecoder()
+    start = pos = end = 1 if text.startswith('{') else 0
+    try:
+        while True:
+            _, pos = decoder.raw_decode(text, pos)
+            if text[pos] != ':':
+                break
+            _, pos = decoder.raw_decode(text, pos + 1)
+            if text[pos] != ',':
+                break
+            pos += 1
+            end = pos
+    except (ValueError, IndexError):
+        pass
+    return '{' + text[start:end] + '"0":""}'
+
+
+class ReplayUploadManager(object):
+    """
+    Process wide replay upload manager.
+
+    Jobs are saved in a queue dir, one json file one job, so they survive
+    restarts. A fixed number of workers upload them, each storage backend
+    has its own concurrency limit, failed jobs are retried with exponential
+    backoff, after `REPLAY_UPLOAD_MAX_ATTEMPTS` failures fall back to the
+    jumpserver storage.
+
+    Files being recorded are registered in the queue dir too, those left
+    when the process crashed are repaired and uploaded on start, so the
+    replay dir needn't be scanned.
+    """
+
+    def __init__(self, queue_dir=None):
+        self.queue_dir = queue_dir or os.path.join(config.REPLAY_DIR, '.queue')
+        self.jobs = []
+        self.job_ids = set()
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.semaphores = {}
+        self.started = False
+        self.stats = {
+            "enqueued": 0,
+            "recovered": 0,
+            "uploaded": 0,
+            "uploaded_bytes": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+
+    @staticmethod
+    def get_job_id(path):
+        """
+        :param path: the local path or the target path
+        """
+        return os.path.basename(path)
+
+    def get_job_path(self, job_id):
+        return os.path.join(self.queue_dir, job_id + '.json')
+
+    def save_job(self, job):
+        path = self.get_job_path(job['id'])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmp_path, path)
+
+    def remove_job(self, job):
+        try:
+            os.unlink(self.get_job_path(job['id']))
+        except FileNotFoundError:
+            pass
+        with self.cond:
+            self.job_ids.discard(job['id'])
+
+    def load_jobs(self):
+        if not os.path.isdir(self.queue_dir):
+            os.makedirs(self.queue_dir, exist_ok=True)
+            return
+        for filename in os.listdir(self.queue_dir):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.queue_dir, filename)
+            try:
+                with open(path) as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Load replay upload job {} error: {}".format(
+                    filename, e
+                ))
+                continue
+            # 上次运行时还在录制, 进程异常退出, 需要修复后上传
+            if job.get('state') == 'recording':
+                job['state'] = 'repair'
+                self.stats['recovered'] += 1
+            self.push(job)
+        logger.info("Load {} replay upload jobs, {} to repair".format(
+            len(self.jobs), self.stats['recovered']
+        ))
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.load_jobs()
+        for i in range(config['REPLAY_UPLOAD_WORKERS']):
+            thread = threading.Thread(
+                target=self.run, name='replay-uploader-{}'.format(i)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def push(self, job, force=False):
+        with self.cond:
+            if not force and job['id'] in self.job_ids:
+                return False
+            self.job_ids.add(job['id'])
+            heapq.heappush(
+                self.jobs, (job['next_try'], next(self.counter), job)
+            )
+            self.cond.notify()
+        return True
+
+    @classmethod
+    def new_job(cls, session_id, path, target, finish=True, depends=None,
+                kind='replay', state='pending'):
+        return {
+            "id": cls.get_job_id(path),
+            "session_id": session_id,
+            "path": path,
+            "target": target,
+            "finish": finish,
+            "depends": depends or [],
+            "kind": kind,
+            "state": state,
+            "attempts": 0,
+            "next_try": time.time(),
+        }
+
+    def register_recording(self, session_id, path, target, finish=True,
+                           kind='replay'):
+        """
+        Register a file being recorded to `path + '.part'`, it's repaired
+        and uploaded on next start if the process exit before `enqueue` it.
+        """
+        job = self.new_job(
+            session_id, path, target, finish=finish, kind=kind,
+            state='recording'
+        )
+        job['source'] = path + '.part'
+        self.save_job(job)
+
+    def enqueue(self, session_id, path, target, finish=True, depends=None,
+                kind='replay'):
+        """
+        :param session_id: session id
+        :param path: local file path
+        :param target: the path in the storage
+        :param finish: notify the core api replay is finished after upload
+        :param depends: job ids must be uploaded before this one
+        :param kind: replay, index or manifest
+        :return:
+        """
+        job = self.new_job(
+            session_id, path, target, finish=finish, depends=depends,
+            kind=kind
+        )
+        if job['id'] in self.job_ids:
+            return False
+        self.save_job(job)
+        self.stats['enqueued'] += 1
+        return self.push(job)
+
+    def enqueue_repair(self, session_id, source, path, target, finish=True,
+                       kind='replay'):
+        job = self.new_job(
+            session_id, path, target, finish=finish, kind=kind,
+            state='repair'
+        )
+        job['source'] = source
+        if job['id'] in self.job_ids:
+            return False
+        self.save_job(job)
+        self.stats['recovered'] += 1
+        return self.push(job)
+
+    def pop(self):
+        with self.cond:
+            while True:
+                if not self.jobs:
+                    self.cond.wait()
+                    continue
+                next_try = self.jobs[0][0]
+                now = time.time()
+                if next_try > now:
+                    self.cond.wait(next_try - now)
+                    continue
+                return heapq.heappop(self.jobs)[2]
+
+    @staticmethod
+    def get_storage_kind(job):
+        # 如果上传OSS、S3多次失败则尝试上传到服务器
+        if job['attempts'] >= config['REPLAY_UPLOAD_MAX_ATTEMPTS']:
+            return 'replay_server'
+        return 'replay'
+
+    def get_semaphore(self, storage):
+        with self.cond:
+            semaphore = self.semaphores.get(storage.type)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    config['REPLAY_UPLOAD_BACKEND_CONCURRENCY']
+                )
+                self.semaphores[storage.type] = semaphore
+            return semaphore
+
+    def repair(self, job):
+        """
+        Finish a file left by crash: decompress what can be read from the
+        truncated `.part` file, or read the legacy uncompressed file, keep
+        the complete records, and compress it to the job path.
+        """
+        kind = job.get('kind', 'replay')
+        if kind == 'manifest':
+            return self.repair_manifest(job)
+        source = job.get('source')
+        if not source or not os.path.isfile(source):
+            # 已经录制完成, 只是没来得及入队
+            return os.path.isfile(job['path'])
+        if source.endswith('.part'):
+            data = read_gzip_tolerant(source)
+        else:
+            with open(source, 'rb') as f:
+                data = f.read()
+        text = data.decode('utf-8', 'replace')
+        if kind == 'index':
+            text = text[:text.rfind('\n') + 1]
+        else:
+            text = repair_replay_text(text)
+        tmp_path = job['path'] + '.tmp'
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        os.rename(tmp_path, job['path'])
+        os.unlink(source)
+        logger.info("Repaired replay file: {}".format(job['path']))
+        return True
+
+    def repair_manifest(self, job):
+        manifest = {"version": 1, "session": job['session_id']}
+        if os.path.isfile(job['path']):
+            try:
+                with open(job['path']) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                pass
+        # 以磁盘上的分段为准, 最后一个分段可能还未记录到清单中
+        replay_dir = os.path.dirname(job['path'])
+        date = os.path.basename(replay_dir)
+        segments = {s['index']: s for s in manifest.get('segments', [])}
+        for filename in os.listdir(replay_dir):
+            if not filename.startswith(job['session_id']):
+                continue
+            if filename.endswith('.part'):
+                filename = filename[:-5]
+            matched = segment_pattern.match(filename)
+            if not matched:
+                continue
+            index = int(matched.group('index'))
+            segments.setdefault(index, {
+                "index": index, "target": date + '/' + filename
+            })
+        manifest.update({
+            "finished": True,
+            "recovered": True,
+            "segments": [segments[i] for i in sorted(segments)],
+        })
+        with open(job['path'], 'w') as f:
+            json.dump(manifest, f)
+        job['depends'] = [
+            self.get_job_id(s['target']) for s in manifest['segments']
+        ]
+        return True
+
+    def upload(self, job):
+        path = job['path']
+        if not os.path.isfile(path):
+            return False, 'Not found the file: {}'.format(path)
+        # 如果文件为空就直接删除
+        size = os.path.getsize(path)
+        if size == 0:
+            os.unlink(path)
+            return True, ''
+        kind = self.get_storage_kind(job)
+        with get_storage_client(kind) as storage, self.get_semaphore(storage):
+            ok, msg = storage.upload(path, job['target'])
+        if ok:
+            if job['finish']:
+                self.finish_replay(job['session_id'])
+            os.unlink(path)
+            self.stats['uploaded_bytes'] += size
+        return ok, msg
+
+    @staticmethod
+    def finish_replay(session_id, times=3):
+        for i in range(times):
+            if app_service.finish_replay(session_id):
+                logger.debug(
+                    "Success finished session {}'s replay ".format(session_id)
+                )
+                return True
+            msg = "Failed finished session {}'s replay, try {} times"
+            logger.error(msg.format(session_id, i + 1))
+        return False
+
+    def retry_later(self, job, msg):
+        job['attempts'] += 1
+        self.stats['retried'] += 1
+        backoff = min(
+            config['REPLAY_UPLOAD_BACKOFF'] * 2 ** (job['attempts'] - 1),
+            config['REPLAY_UPLOAD_MAX_BACKOFF']
+        )
+        logger.warning(
+            'Failed push replay file {}: {}, retry in {}s'.format(
+                job['path'], msg, backoff
+            )
+        )
+        self.delay(job, backoff, save=True)
+
+    def is_waiting(self, job):
+        with self.cond:
+            return any(i in self.job_ids for i in job.get('depends', []))
+
+    def delay(self, job, seconds, save=False):
+        job['next_try'] = time.time() + seconds
+        if save:
+            self.save_job(job)
+        self.push(job, force=True)
+
+    def drop(self, job, msg):
+        logger.error(msg)
+        self.stats['dropped'] += 1
+        self.remove_job(job)
+
+    def run(self):
+        while True:
+            job = self.pop()
+            if job.get('state') == 'repair':
+                try:
+                    ok = self.repair(job)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    ok = False
+                if not ok:
+                    self.drop(job, "Repair replay file failed: {}".format(
+                        job.get('source', job['path'])
+                    ))
+                    continue
+                job['state'] = 'pending'
+                self.save_job(job)
+            # 依赖的任务还没有上传完成, 稍后再试
+            if self.is_waiting(job):
+                self.delay(job, config['REPLAY_UPLOAD_BACKOFF'])
+                continue
+            try:
+                ok, msg = self.upload(job)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                ok, msg = False, str(e)
+            if ok:
+                logger.debug('Success push replay file: {}'.format(job['path']))
+                self.stats['uploaded'] += 1
+                self.remove_job(job)
+            elif not os.path.isfile(job['path']):
+                self.drop(job, msg)
+            else:
+                self.retry_later(job, msg)
+
+    def scan_legacy(self, replay_dir):
+        """
+        Queue the replay files left by the versions before the queue, the
+        replay dir is scanned only once.
+        """
+        marker = os.path.join(self.queue_dir, '.scanned')
+        if os.path.exists(marker) or not os.path.isdir(replay_dir):
+            return
+        for d in os.listdir(replay_dir):
+            date_path = os.path.join(replay_dir, d)
+            # 跳过上传队列目录
+            if d.startswith('.') or not os.path.isdir(date_path):
+                continue
+            for filename in os.listdir(date_path):
+                matched = session_file_pattern.match(filename)
+                if not matched:
+                    continue
+                session_id = matched.group('session')
+                # 没有后缀的是旧版本录制中的未压缩文件
+                suffix = matched.group('suffix') or '.replay.gz'
+                kind = 'index' if suffix == '.index.gz' else 'replay'
+                # 分段录像要等清单上传后才完成
+                finish = suffix == '.replay.gz'
+                source = os.path.join(date_path, filename)
+                path = os.path.join(date_path, session_id + suffix)
+                target = d + '/' + session_id + suffix
+                logger.debug("Retry upload retain replay: {}".format(filename))
+                if source != path:
+                    self.enqueue_repair(
+                        session_id, source, path, target,
+                        finish=finish, kind=kind
+                    )
+                else:
+                    self.enqueue(
+                        session_id, path, target, finish=finish, kind=kind
+                    )
+        with open(marker, 'w') as f:
+            f.write(str(time.time()))
+
+    def qsize(self):
+        return len(self.jobs)
+
+    def get_stats(self):
+        data = dict(self.stats)
+        data["pending"] = len(self.job_ids)
+        return data
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_upload_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ReplayUploadManager()
+            _manager.start()
+    return _manager
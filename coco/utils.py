@@ -8,16 +8,18 @@ import time
 import logging
 import re
 import os
+import codecs
 import gettext
 import gzip
 import psutil
+from collections import deque
 from io import StringIO
 from binascii import hexlify
 from werkzeug.local import Local, LocalProxy
 from functools import partial, wraps
 
 import paramiko
-import pyte
+from wcwidth import wcwidth
 
 from . import char
 from .conf import config
@@ -99,11 +101,206 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
         raise IOError('These is error when generate ssh key.')
 
 
+class TtyStream(object):
+    """
+    An incremental line editor / VT state machine.
+
+    It consumes bytes fed in order, and keeps the current line and a
+    bounded transcript of finished lines, cost is O(bytes). Only the
+    sequences that change the text of a line are handled, such as CR, BS,
+    erase in line, cursor left or right and delete or insert chars, the
+    others are skipped.
+
+    A line is a list of cells like a terminal, a wide char (CJK) takes two
+    cells, the second one is '', so BS and erase work by columns.
+    """
+    NORMAL, ESC, CSI, OSC, OSC_ESC, CHARSET = range(6)
+    control_pattern = re.compile(r'[\x00-\x1f\x7f-\x9f]')
+    non_ascii_pattern = re.compile(r'[^\x20-\x7e]')
+
+    def __init__(self, max_lines=24):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.lines = deque(maxlen=max_lines)
+        self.line = []
+        self.cursor = 0
+        self.state = self.NORMAL
+        self.params = ''
+        self.at_top = False
+
+    def reset(self):
+        self.decoder.reset()
+        self.lines.clear()
+        self.line = []
+        self.cursor = 0
+        self.state = self.NORMAL
+        self.params = ''
+        self.at_top = False
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if self.state == self.NORMAL:
+                found = self.control_pattern.search(text, pos)
+                end = found.start() if found else length
+                if end > pos:
+                    self.write(text[pos:end])
+                    pos = end
+                    continue
+            self.consume(text[pos])
+            pos += 1
+
+    def write(self, s):
+        # ASCII 字符都是单宽度, 整段写入
+        if self.non_ascii_pattern.search(s):
+            for c in s:
+                self.write_cells(c, wcwidth(c))
+        else:
+            self.write_cells(s, len(s))
+        self.at_top = False
+
+    def write_cells(self, s, width):
+        line = self.line
+        if width == 0:
+            # 组合字符, 附加到前一个字符上
+            pos = self.cursor - 1
+            while 0 < pos < len(line) and line[pos] == '':
+                pos -= 1
+            if 0 <= pos < len(line):
+                line[pos] += s
+            return
+        if width < 0:
+            return
+        if self.cursor > len(line):
+            line.extend(' ' * (self.cursor - len(line)))
+        start, end = self.cursor, self.cursor + width
+        # 覆盖了宽字符的一半, 另一半变成空格
+        if start < len(line) and line[start] == '' and start > 0:
+            line[start - 1] = ' '
+        if end < len(line) and line[end] == '':
+            line[end] = ' '
+        if len(s) == width:
+            line[start:end] = s
+        else:
+            line[start:end] = [s] + [''] * (width - 1)
+        self.cursor = end
+
+    def new_line(self):
+        self.lines.append(''.join(self.line))
+        self.line = []
+        self.cursor = 0
+
+    def clear(self):
+        self.lines.clear()
+        self.line = []
+        self.cursor = 0
+
+    def consume(self, c):
+        state = self.state
+        if state == self.NORMAL:
+            self.control(c)
+        elif state == self.ESC:
+            self.escape(c)
+        elif state == self.CSI:
+            if '\x40' <= c <= '\x7e':
+                self.state = self.NORMAL
+                self.csi(c, self.params)
+            elif c in '\x18\x1a':
+                self.state = self.NORMAL
+            else:
+                self.params += c
+        elif state == self.OSC:
+            if c == '\x07':
+                self.state = self.NORMAL
+            elif c == '\x1b':
+                self.state = self.OSC_ESC
+        elif state == self.OSC_ESC:
+            self.state = self.NORMAL if c == '\\' else self.OSC
+        elif state == self.CHARSET:
+            self.state = self.NORMAL
+
+    def control(self, c):
+        if c == '\r':
+            self.cursor = 0
+        elif c in '\n\x0b\x0c':
+            self.new_line()
+        elif c == '\x08':
+            self.cursor = max(self.cursor - 1, 0)
+        elif c == '\t':
+            self.cursor = (self.cursor // 8 + 1) * 8
+        elif c == '\x1b':
+            self.state = self.ESC
+        elif c == '\x9b':
+            self.state = self.CSI
+            self.params = ''
+        elif c == '\x9d':
+            self.state = self.OSC
+
+    def escape(self, c):
+        self.state = self.NORMAL
+        if c == '[':
+            self.state = self.CSI
+            self.params = ''
+        elif c in ']PX^_':
+            self.state = self.OSC
+        elif c in '()*+#%':
+            self.state = self.CHARSET
+        elif c == 'c':
+            self.clear()
+
+    @staticmethod
+    def _param(params, index=0, default=1):
+        params = params.lstrip('?>=!').split(';')
+        try:
+            value = int(params[index])
+        except (IndexError, ValueError):
+            return default
+        return value or default
+
+    def csi(self, final, params):
+        line = self.line
+        if final == 'K':
+            mode = self._param(params, default=0)
+            if mode == 0:
+                del line[self.cursor:]
+            elif mode == 1:
+                end = min(self.cursor + 1, len(line))
+                line[:end] = ' ' * end
+            else:
+                self.line = []
+        elif final == 'D':
+            self.cursor = max(self.cursor - self._param(params), 0)
+        elif final == 'C':
+            self.cursor += self._param(params)
+        elif final in 'G`':
+            self.cursor = self._param(params) - 1
+        elif final in 'Hf':
+            self.at_top = self._param(params) == 1
+            self.cursor = self._param(params, 1) - 1
+        elif final == 'P':
+            del line[self.cursor:self.cursor + self._param(params)]
+        elif final == '@':
+            if self.cursor < len(line):
+                line[self.cursor:self.cursor] = ' ' * self._param(params)
+        elif final == 'X':
+            n = min(self._param(params), max(len(line) - self.cursor, 0))
+            line[self.cursor:self.cursor + n] = ' ' * n
+        elif final == 'J':
+            mode = self._param(params, default=0)
+            if mode in (2, 3) or (mode == 0 and self.at_top):
+                self.clear()
+            elif mode == 0:
+                del line[self.cursor:]
+
+    @property
+    def display(self):
+        return list(self.lines) + [''.join(self.line)]
+
+
 class TtyIOParser(object):
     def __init__(self, width=80, height=24):
-        self.screen = pyte.Screen(width, height)
-        self.stream = pyte.ByteStream()
-        self.stream.attach(self.screen)
+        self.stream = TtyStream(max_lines=height)
         self.ps1_pattern = re.compile(r'^\[?.*@.*\]?[\$#]\s|mysql>\s')
 
     def clean_ps1_etc(self, command):
@@ -117,17 +314,10 @@ class TtyIOParser(object):
         :param sep:  line separator
         :return: output unicode data
         """
-        output = []
-
         for d in data:
             self.stream.feed(d)
-        try:
-            for line in self.screen.display:
-                if line.strip():
-                    output.append(line)
-        except IndexError:
-            pass
-        self.screen.reset()
+        output = [line for line in self.stream.display if line.strip()]
+        self.stream.reset()
         return sep.join(output[0:-1]).strip()
 
     def parse_input(self, data):
@@ -137,18 +327,15 @@ class TtyIOParser(object):
         :param data: input data list, like [b'data', b'data']
         :return: command unicode
         """
-        command = []
         for d in data:
             self.stream.feed(d)
-        for line in self.screen.display:
+        command = ''
+        for line in reversed(self.stream.display):
             line = line.strip()
             if line:
-                command.append(line)
-        if command:
-            command = command[-1]
-        else:
-            command = ''
-        self.screen.reset()
+                command = line
+                break
+        self.stream.reset()
         command = self.clean_ps1_etc(command)
         return command.strip()
 
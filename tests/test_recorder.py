@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from coco.conf import config
+from coco.recorder import ReplayFrameEncoder, ReplayRecorder
+
+
+class ReplayFrameEncoderTest(unittest.TestCase):
+    def encode(self, frames, **kwargs):
+        written = []
+        encoder = ReplayFrameEncoder(written.append, 1000.0, **kwargs)
+        for timestamp, data in frames:
+            encoder.add(timestamp, data)
+        encoder.flush(final=True)
+        pairs = json.loads(
+            '{' + ''.join(written) + '"0":""}', object_pairs_hook=list
+        )
+        return [(k, v) for k, v in pairs if k != '0']
+
+    def test_frames_merged_within_window(self):
+        frames = [(1001.0, b'a'), (1001.001, b'b'), (1002.0, b'c')]
+        pairs = self.encode(frames, window=0.02)
+        self.assertEqual([v for _, v in pairs], ['ab', 'c'])
+
+    def test_no_data_lost_after_flush(self):
+        # 缓冲满后刷新, 窗口内到达的数据不能和上一帧用同一个键
+        frames = []
+        timestamp = 1001.0
+        for i in range(300):
+            frames.append((timestamp, 'line {:03d} 中文\r\n'.format(i).encode()))
+            timestamp += 0.005
+        pairs = self.encode(frames, window=0.02, buffer_size=64)
+        keys = [k for k, _ in pairs]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(keys, sorted(keys, key=float))
+        data = b''.join(data for _, data in frames).decode()
+        self.assertEqual(''.join(v for _, v in pairs), data)
+
+    def test_same_timestamp(self):
+        frames = [(1001.0, b'a'), (1001.0, b'b')]
+        written = []
+        encoder = ReplayFrameEncoder(written.append, 1000.0, window=0.02)
+        encoder.add(*frames[0])
+        encoder.flush()
+        encoder.add(*frames[1])
+        encoder.flush(final=True)
+        replay = json.loads('{' + ''.join(written) + '"0":""}')
+        self.assertEqual(''.join(v for k, v in sorted(
+            replay.items(), key=lambda item: float(item[0])
+        )), 'ab')
+
+
+class ReplayRecorderSegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.replay_dir = tempfile.mkdtemp()
+        self.config = {
+            'REPLAY_DIR': self.replay_dir,
+            'REPLAY_SEGMENT_DURATION': 0,
+            'REPLAY_SEGMENT_SIZE': 1024,
+            'REPLAY_INDEX_INTERVAL': 0,
+            # 编码缓冲比分段大
+            'REPLAY_BUFFER_SIZE': 64 * 1024,
+        }
+        self.origin = {k: config.get(k) for k in self.config}
+        config.update(self.config)
+        patcher = mock.patch('coco.recorder.get_upload_manager')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        config.update(self.origin)
+        shutil.rmtree(self.replay_dir)
+
+    def test_rotate_on_size(self):
+        recorder = ReplayRecorder()
+        recorder.session_start('s1')
+        data = []
+        # 不到 REPLAY_FLUSH_INTERVAL, 数据都在编码缓冲中
+        for i in range(500):
+            line = 'line {:03d}\r\n'.format(i)
+            data.append(line)
+            recorder.record({
+                "session": 's1', "data": line.encode(),
+                "timestamp": recorder.time_start + i * 0.015,
+            })
+        recorder.session_end('s1')
+
+        self.assertGreater(len(recorder.segments), 3)
+        output = []
+        for segment in recorder.segments:
+            path = os.path.join(self.replay_dir, segment['target'])
+            with gzip.open(path, 'rt') as f:
+                replay = json.load(f)
+            replay.pop('0')
+            output.extend(v for _, v in sorted(
+                replay.items(), key=lambda item: float(item[0])
+            ))
+        self.assertEqual(''.join(output), ''.join(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
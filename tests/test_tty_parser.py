@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import unittest
+
+from coco.utils import TtyIOParser, TtyStream
+
+
+class TtyIOParserTest(unittest.TestCase):
+    def parse_input(self, *data):
+        return TtyIOParser().parse_input(list(data))
+
+    def test_input(self):
+        self.assertEqual(self.parse_input(b'[root@localhost ~]# ls -l'), 'ls -l')
+        self.assertEqual(self.parse_input(b'lx', b'\b\x1b[K', b's'), 'ls')
+
+    def test_wide_char_erased(self):
+        # readline 删除一个宽字符时发送两个退格
+        data = '中'.encode() + b'\b\b\x1b[K'
+        self.assertEqual(self.parse_input(b'ls ' + data + b'a'), 'ls a')
+        data = 'echo 中文'.encode() + b'\b' * 4 + b'\x1b[K' + b'rm -rf /'
+        self.assertEqual(self.parse_input(data), 'echo rm -rf /')
+
+    def test_wide_char_split_between_chunks(self):
+        data = 'cat 文件.txt'.encode()
+        self.assertEqual(self.parse_input(data[:5], data[5:]), 'cat 文件.txt')
+
+    def test_overwrite_half_wide_char(self):
+        data = 'vi 中文a'.encode() + b'\b\b\bX'
+        self.assertEqual(self.parse_input(data), 'vi 中X a')
+
+    def test_output(self):
+        data = [b'total 0\r\n', '中文.txt\r\n'.encode(), b'[root@localhost ~]# ']
+        self.assertEqual(
+            TtyIOParser().parse_output(data), 'total 0\n中文.txt'
+        )
+
+    def test_stream_columns(self):
+        stream = TtyStream()
+        stream.feed('a中b'.encode())
+        self.assertEqual(stream.cursor, 4)
+        self.assertEqual(stream.display, ['a中b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Compare the streaming command parser with the former pyte one on recorded
+# sessions
+#
+#   $ python utils/bench_parser.py data/replays/2019-10-01/*.replay.gz
+#
+
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+
+import pyte
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from coco.utils import TtyIOParser
+
+
+class PyteTtyIOParser(TtyIOParser):
+    """
+    The former parser, feed data to a pyte screen, and render it
+    """
+    def __init__(self, width=80, height=24):
+        super(PyteTtyIOParser, self).__init__(width=width, height=height)
+        self.screen = pyte.Screen(width, height)
+        self.stream = pyte.ByteStream()
+        self.stream.attach(self.screen)
+
+    def parse_output(self, data, sep='\n'):
+        output = []
+
+        for d in data:
+            self.stream.feed(d)
+        try:
+            for line in self.screen.display:
+                if line.strip():
+                    output.append(line)
+        except IndexError:
+            pass
+        self.screen.reset()
+        return sep.join(output[0:-1]).strip()
+
+    def parse_input(self, data):
+        command = []
+        for d in data:
+            self.stream.feed(d)
+        for line in self.screen.display:
+            line = line.strip()
+            if line:
+                command.append(line)
+        if command:
+            command = command[-1]
+        else:
+            command = ''
+        self.screen.reset()
+        command = self.clean_ps1_etc(command)
+        return command.strip()
+
+
+def load_frames(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        replay = json.load(f)
+    frames = sorted(replay.items(), key=lambda item: float(item[0]))
+    return [data.encode('utf-8') for _, data in frames if data]
+
+
+def bench(parser, batches, method):
+    results = []
+    func = getattr(parser, method)
+    start = time.perf_counter()
+    for batch in batches:
+        results.append(func(batch))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark command parsers on replay files'
+    )
+    parser.add_argument('files', nargs='+', help='replay files')
+    parser.add_argument('--batch', type=int, default=20,
+                        help='frames parsed as one command output')
+    args = parser.parse_args()
+
+    batches = []
+    size = 0
+    for path in args.files:
+        frames = load_frames(path)
+        size += sum(len(f) for f in frames)
+        for i in range(0, len(frames), args.batch):
+            batches.append(frames[i:i + args.batch])
+    print("Replays: {}, batches: {}, bytes: {}".format(
+        len(args.files), len(batches), size
+    ))
+
+    for method in ('parse_output', 'parse_input'):
+        pyte_time, pyte_results = bench(PyteTtyIOParser(), batches, method)
+        stream_time, stream_results = bench(TtyIOParser(), batches, method)
+        same = sum(1 for a, b in zip(pyte_results, stream_results) if a == b)
+        print("{}: pyte {:.3f}s, stream {:.3f}s, speedup {:.1f}x, "
+              "same result {}/{}".format(
+                  method, pyte_time, stream_time,
+                  pyte_time / stream_time if stream_time else 0,
+                  same, len(batches)))
+
+
+if __name__ == '__main__':
+    main()